@@ -0,0 +1,49 @@
+"""
+Benchmark the local trace cache backends.
+
+Times set and get of trace sized values on the lru backend against werkzeug SimpleCache,
+with the caches filled past their bounds so eviction and pruning are included.
+
+    python benchmarks/bench_cache.py
+"""
+
+import os
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.contrib.cache import SimpleCache  # NOQA
+from flask_logex.caches import LRUCache  # NOQA
+
+ENTRIES = 500
+OPERATIONS = 20000
+VALUE = 'x' * 4096
+
+caches = [
+    ('simple', lambda: SimpleCache(threshold=ENTRIES)),
+    ('lru', lambda: LRUCache(max_bytes=ENTRIES * len(VALUE))),
+]
+
+
+def run():
+    keys = ['%040x' % i for i in range(OPERATIONS)]
+    for name, factory in caches:
+        cache = factory()
+        start = default_timer()
+        for key in keys:
+            cache.set(key, VALUE)
+        writes = default_timer() - start
+        recent = keys[-ENTRIES // 2:]
+        start = default_timer()
+        for i in range(OPERATIONS):
+            cache.get(recent[i % len(recent)])
+        reads = default_timer() - start
+        print "%-8s set %7.2f us  get %7.2f us" % (
+            name,
+            writes / OPERATIONS * 1e6,
+            reads / OPERATIONS * 1e6)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+"""
+Benchmark resolving the handler and logger of an exception.
+
+Compares the dispatch cache against scanning every registered logger with issubclass,
+with a few hundred registered exception types.
+
+    python benchmarks/bench_dispatch.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask  # NOQA
+from flask_logex import LogEx  # NOQA
+
+NUMBER = 20000
+TYPES = 300
+
+base = type('BaseError', (Exception,), {})
+exceptions = [type('Error%d' % i, (base,), {}) for i in range(TYPES)]
+# Raised exception subclassing the last registered type
+raised = type('RaisedError', (exceptions[-1],), {})
+
+app = Flask("bench")
+logex = LogEx(app=app,
+              handlers=dict((exc, None) for exc in exceptions),
+              loggers=dict((exc, "bench") for exc in exceptions))
+
+
+def scan(exc_type):
+    """Logger resolution scanning every registered exception."""
+    _loggers = logex.loggers.keys()
+    if issubclass(exc_type, tuple(_loggers)):
+        key = [i for i in _loggers if issubclass(exc_type, i)][0]
+        return logex.loggers[key]
+    return app.logger_name
+
+
+def run():
+    logex.dispatch(raised)
+    for name, resolve in (('scan', scan), ('dispatch', logex.dispatch)):
+        elapsed = timeit.timeit(lambda: resolve(raised), number=NUMBER)
+        print "%-10s %4d types  %8.2f us" % (name, TYPES, elapsed / NUMBER * 1e6)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,53 @@
+"""
+Benchmark the import time of flask_logex.
+
+Times fresh interpreters importing flask, flask_logex, and the packages of the integrations
+in flask_logex.defaults that are installed, which are only imported once activated.
+
+    python benchmarks/bench_import.py
+"""
+
+import os
+import subprocess
+import sys
+from timeit import default_timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RUNS = 10
+
+sys.path.insert(0, ROOT)
+
+from flask_logex.defaults import __plugins__  # NOQA
+
+
+def measure(statement):
+    """Median seconds of a fresh interpreter running the statement, None on failure."""
+    timings = []
+    for i in range(RUNS):
+        start = default_timer()
+        if subprocess.call([sys.executable, '-c', statement], cwd=ROOT,
+                           stderr=open(os.devnull, 'w')):
+            return None
+        timings.append(default_timer() - start)
+    return sorted(timings)[RUNS // 2]
+
+
+def run():
+    baseline = measure('pass')
+    flask = measure('import flask')
+    logex = measure('import flask_logex')
+    print "%-28s %7.1f ms" % ('interpreter', baseline * 1e3)
+    print "%-28s %7.1f ms" % ('flask', (flask - baseline) * 1e3)
+    print "%-28s %7.1f ms" % ('flask_logex', (logex - baseline) * 1e3)
+    for name, plugin in sorted(__plugins__.items()):
+        eager = measure('import flask_logex; from flask_logex.defaults import __plugins__; '
+                        '__plugins__[%r].load()' % name)
+        if eager is None:
+            print "%-28s %s not installed" % ('flask_logex + ' + name, plugin.package)
+            continue
+        print "%-28s %7.1f ms  (%.1f ms saved while inactive)" % (
+            'flask_logex + ' + name, (eager - baseline) * 1e3, (eager - logex) * 1e3)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,79 @@
+"""
+Benchmark log writes through per logger file handlers and the shared log sink.
+
+Forked workers log records to several loggers of one directory, either with a
+logging.FileHandler per logger or through one flask_logex.sink.LogSink rotating the files.
+
+    python benchmarks/bench_logs.py
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask_logex.sink import LogSink  # NOQA
+
+RECORDS = 20000
+LOGGERS = ['app', 'custom_exception', 'boto', 'webargs']
+MESSAGE = 'x' * 200
+
+
+def file_handlers(directory):
+    handlers = {}
+    for log_name in LOGGERS:
+        handlers[log_name] = logging.FileHandler(os.path.join(directory, log_name + '.log'))
+    return handlers
+
+
+def sink(directory):
+    shared = LogSink(directory, max_bytes=8 * 1024 * 1024)
+    for log_name in LOGGERS:
+        shared.add(log_name)
+    return dict((log_name, shared) for log_name in LOGGERS)
+
+
+def write(handlers):
+    loggers = []
+    for log_name in LOGGERS:
+        logger = logging.Logger(log_name)
+        logger.addHandler(handlers[log_name])
+        loggers.append(logger)
+    for i in range(RECORDS):
+        loggers[i % len(loggers)].error(MESSAGE)
+    for handler in set(handlers.values()):
+        handler.close()
+
+
+def run():
+    for mode in (file_handlers, sink):
+        for workers in (1, 4):
+            directory = tempfile.mkdtemp(prefix='logex-bench-')
+            try:
+                handlers = mode(directory)
+                start = default_timer()
+                pids = []
+                for i in range(workers):
+                    pid = os.fork()
+                    if pid == 0:
+                        try:
+                            write(handlers)
+                        finally:
+                            os._exit(0)
+                    pids.append(pid)
+                for pid in pids:
+                    os.waitpid(pid, 0)
+                elapsed = default_timer() - start
+                files = len(os.listdir(directory))
+            finally:
+                shutil.rmtree(directory)
+            print "%-14s workers %d  %8.0f records/s  %2d files" % (
+                mode.__name__, workers, workers * RECORDS / elapsed, files)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,46 @@
+"""
+Benchmark LogEx.process_response overhead on successful responses.
+
+Compares the after request hook against the json.loads of the response body
+it previously performed for every response.
+
+    python benchmarks/bench_process_response.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask  # NOQA
+from flask import jsonify  # NOQA
+from flask_logex import LogEx  # NOQA
+
+NUMBER = 2000
+
+app = Flask("bench")
+logex = LogEx(app=app)
+
+
+def payload(size):
+    """Successful JSON payload with `size` items."""
+    return [{"id": i, "name": "item-%d" % i, "active": True} for i in range(size)]
+
+
+def run():
+    with app.test_request_context():
+        for size in (0, 100, 10000):
+            response = jsonify(items=payload(size))
+            hook = timeit.timeit(lambda: logex.process_response(response), number=NUMBER)
+            parse = timeit.timeit(lambda: json.loads(response.data), number=NUMBER)
+            print "%6d items  %8d bytes  process_response %8.2f us  json.loads %8.2f us" % (
+                size,
+                len(response.data),
+                hook / NUMBER * 1e6,
+                parse / NUMBER * 1e6)
+
+
+if __name__ == '__main__':
+    run()
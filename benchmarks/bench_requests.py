@@ -0,0 +1,261 @@
+"""
+Request path benchmarks of the LogEx extension.
+
+Drives the Flask test client against an app built like tests/samples.py and reports the
+per-request latency and throughput of successful responses, handled AppExceptions and
+unhandled errors, with tracing off and on every cache backend. Redis and memcached are
+replaced by in-process stand-ins so only the LogEx side is measured.
+
+Results are written as JSON, to stdout or the --output file ::
+
+    python benchmarks/bench_requests.py --requests 2000 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask  # NOQA
+from flask import jsonify  # NOQA
+from flask_restful import Api, Resource  # NOQA
+from werkzeug.contrib.cache import MemcachedCache, RedisCache  # NOQA
+
+import flask_logex  # NOQA
+from flask_logex import LogEx  # NOQA
+from flask_logex.exceptions import AppException  # NOQA
+
+
+class SampleException(AppException):
+    error_type = "test_error"
+    error_message = "test_message"
+
+
+class OkResource(Resource):
+    def get(self):
+        return {}, 200
+
+
+class SampleResource(Resource):
+    def get(self):
+        raise SampleException('Resource Test Error')
+
+
+class ErrorResource(Resource):
+    def get(self):
+        return {}['missing']
+
+
+#
+# Local stand-ins for the remote cache clients
+#
+class FakeRedis(object):
+    """Subset of redis.Redis used by werkzeug RedisCache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, name, value):
+        self.data[name] = value
+        return True
+
+    def setex(self, name, value, time):
+        return self.set(name, value)
+
+    def setnx(self, name, value):
+        if name in self.data:
+            return False
+        return self.set(name, value)
+
+    def expire(self, name, time):
+        return True
+
+    def incr(self, name, amount=1):
+        self.data[name] = str(int(self.data.get(name, 0)) + amount)
+        return int(self.data[name])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, *args, **kwargs):
+        self.commands.append((self.client.set, args, kwargs))
+
+    def setex(self, *args, **kwargs):
+        self.commands.append((self.client.setex, args, kwargs))
+
+    def execute(self):
+        return [command(*args, **kwargs) for command, args, kwargs in self.commands]
+
+
+class FakeMemcached(object):
+    """Subset of memcache.Client used by werkzeug MemcachedCache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_multi(self, keys):
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+    def set(self, key, value, timeout=0):
+        self.data[key] = value
+        return True
+
+    def set_multi(self, mapping, timeout=0):
+        self.data.update(mapping)
+        return []
+
+    def add(self, key, value, timeout=0):
+        if key in self.data:
+            return False
+        return self.set(key, value)
+
+    def incr(self, key, delta=1):
+        if key not in self.data:
+            return None
+        self.data[key] += delta
+        return self.data[key]
+
+
+def fake_redis(app, config, args, kwargs):
+    return RedisCache(FakeRedis(), *args, **kwargs)
+
+
+def fake_memcached(app, config, args, kwargs):
+    return MemcachedCache(FakeMemcached(), *args, **kwargs)
+
+
+def build_app(name, cache_config):
+    """Flask app with routes and Flask-RESTful resources like tests/samples.py."""
+    app = Flask(name)
+    api = Api(app)
+
+    @app.route('/app/ok')
+    def ok():
+        return jsonify({})
+
+    @app.route('/app/sample')
+    def sample():
+        raise SampleException('Route Test Error')
+
+    api.add_resource(OkResource, '/api/ok')
+    api.add_resource(SampleResource, '/api/sample')
+    api.add_resource(ErrorResource, '/api/error')
+    logex = LogEx(app=app, api=api, cache_config=cache_config)
+    return app, logex
+
+
+def backends(cache_dir):
+    """Cache configurations benchmarked for traced errors."""
+    return [
+        ('null', {'LOGEX_CACHE_TYPE': 'null'}),
+        ('simple', {'LOGEX_CACHE_TYPE': 'simple'}),
+        ('lru', {'LOGEX_CACHE_TYPE': 'lru'}),
+        ('filesystem', {'LOGEX_CACHE_TYPE': 'filesystem', 'LOGEX_CACHE_DIR': cache_dir}),
+        ('segment', {'LOGEX_CACHE_TYPE': 'segment',
+                     'LOGEX_CACHE_DIR': os.path.join(cache_dir, 'segments')}),
+        ('sqlite', {'LOGEX_CACHE_TYPE': 'sqlite', 'LOGEX_CACHE_DIR': cache_dir}),
+        ('redis', {'LOGEX_CACHE_TYPE': '__main__.fake_redis'}),
+        ('memcached', {'LOGEX_CACHE_TYPE': '__main__.fake_memcached'}),
+        ('tiered', {'LOGEX_CACHE_TYPE': 'tiered',
+                    'LOGEX_CACHE_TIERED_BACKEND': '__main__.fake_redis'}),
+    ]
+
+
+def measure(client, url, requests, status):
+    """Latency statistics in microseconds and throughput of GET requests to url."""
+    # Warm up routing, loggers and cache clients
+    for i in range(min(50, requests)):
+        client.get(url)
+    latencies = []
+    start = default_timer()
+    for i in range(requests):
+        began = default_timer()
+        response = client.get(url)
+        latencies.append(default_timer() - began)
+        assert response.status_code == status, (url, response.status_code)
+    elapsed = default_timer() - start
+    latencies.sort()
+    return dict(
+        requests=requests,
+        mean_us=sum(latencies) / requests * 1e6,
+        p50_us=latencies[requests // 2] * 1e6,
+        p99_us=latencies[min(requests - 1, int(requests * 0.99))] * 1e6,
+        throughput_rps=requests / elapsed,
+    )
+
+
+def run(requests):
+    cache_dir = tempfile.mkdtemp(prefix='logex-bench-')
+    log_dir = tempfile.mkdtemp(prefix='logex-bench-logs-')
+    os.environ['LOG_PATH'] = log_dir + '/'
+    results = []
+    try:
+        # Successful and handled AppException responses, no tracing
+        app, logex = build_app('bench_null', {'LOGEX_CACHE_TYPE': 'null'})
+        client = app.test_client()
+        for scenario, url, status in (('ok', '/app/ok', 200),
+                                      ('ok_restful', '/api/ok', 200),
+                                      ('app_exception', '/app/sample', 422),
+                                      ('app_exception_restful', '/api/sample', 422)):
+            result = measure(client, url, requests, status)
+            result.update(scenario=scenario, backend='null', url=url)
+            results.append(result)
+
+        # Unhandled errors through Flask-RESTful Api.handle_error, tracing off and per backend
+        app, logex = build_app('bench_untraced', {'LOGEX_CACHE_TYPE': 'null'})
+        logex.trace_codes = []
+        logex.reset_dispatch()
+        result = measure(app.test_client(), '/api/error', requests, 500)
+        result.update(scenario='unhandled_untraced', backend='null', url='/api/error')
+        results.append(result)
+        for backend, cache_config in backends(cache_dir):
+            app, logex = build_app('bench_' + backend, cache_config)
+            result = measure(app.test_client(), '/api/error', requests, 500)
+            result.update(scenario='unhandled_traced', backend=backend, url='/api/error')
+            results.append(result)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    return dict(
+        version=flask_logex.__version__,
+        python=platform.python_version(),
+        timestamp=time.time(),
+        results=results,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per scenario')
+    parser.add_argument('--output', help='JSON results file, stdout by default')
+    options = parser.parse_args()
+    report = json.dumps(run(options.requests), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
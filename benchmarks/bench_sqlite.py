@@ -0,0 +1,81 @@
+"""
+Benchmark trace inserts into the sqlite cache under concurrent writers.
+
+Writers are threads or forked processes sharing one database, each storing batches of
+trace sized rows with their columns through SQLiteCache.set_traces.
+
+    python benchmarks/bench_sqlite.py
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask_logex.sqlite import SQLiteCache  # NOQA
+
+ROWS = 4000
+VALUE = 'x' * 4096
+
+
+def write(cache, writer, batch_size):
+    """Insert this writer's share of the rows in batches."""
+    rows = []
+    for i in range(ROWS):
+        columns = dict(timestamp=time.time(), code=500, endpoint='orders',
+                       exception='KeyError', fingerprint=None)
+        rows.append(('%d-%040x' % (writer, i), VALUE, columns))
+        if len(rows) == batch_size:
+            cache.set_traces(rows)
+            rows = []
+    if rows:
+        cache.set_traces(rows)
+
+
+def threads(cache, writers, batch_size):
+    workers = [threading.Thread(target=write, args=(cache, i, batch_size))
+               for i in range(writers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def processes(cache, writers, batch_size):
+    pids = []
+    for i in range(writers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                write(cache, i, batch_size)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def run():
+    for mode in (threads, processes):
+        for writers in (1, 4):
+            for batch_size in (1, 100):
+                directory = tempfile.mkdtemp(prefix='logex-bench-')
+                try:
+                    cache = SQLiteCache(os.path.join(directory, 'traces.sqlite'),
+                                        default_timeout=0, busy_timeout=60)
+                    start = default_timer()
+                    mode(cache, writers, batch_size)
+                    elapsed = default_timer() - start
+                finally:
+                    shutil.rmtree(directory)
+                print "%-10s writers %d  batch %3d  %8.0f rows/s" % (
+                    mode.__name__, writers, batch_size, writers * ROWS / elapsed)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,79 @@
+"""
+Benchmark trace serialization formats.
+
+Reports the stored size and encode/decode time of a realistic trace in each format.
+
+    python benchmarks/bench_trace_format.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask  # NOQA
+from flask import jsonify  # NOQA
+from flask import request  # NOQA
+from flask_logex.trace import BinarySerializer  # NOQA
+from flask_logex.trace import LegacySerializer  # NOQA
+from flask_logex.trace import Trace  # NOQA
+from flask_logex.trace import Tracer  # NOQA
+
+NUMBER = 5000
+
+app = Flask("bench")
+
+formats = [
+    ('legacy', LegacySerializer()),
+    ('binary', BinarySerializer()),
+    ('binary+zlib', BinarySerializer(compress=True)),
+]
+
+
+def failing(depth):
+    """Raise from a few frames deep for a realistic stack trace."""
+    if depth:
+        return failing(depth - 1)
+    return {}["missing"]
+
+
+def capture():
+    """Snapshot of a failed JSON POST."""
+    body = json.dumps({"items": [{"id": i, "sku": "sku-%d" % i, "quantity": i % 7}
+                                 for i in range(40)]})
+    headers = {
+        'Authorization': 'Bearer ' + 'x' * 120,
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36',
+        'Accept': 'application/json',
+    }
+    with app.test_request_context('/orders', method='POST', data=body,
+                                  content_type='application/json', headers=headers):
+        response = jsonify(error=dict(code=500, message="'missing'", type="internal_server_error"))
+        try:
+            failing(10)
+        except KeyError:
+            return Tracer(None).snapshot(request) + [response.data]
+
+
+def run():
+    snapshot = capture()
+    for name, serializer in formats:
+        data = serializer.dumps(snapshot)
+        encode = timeit.timeit(lambda: serializer.dumps(snapshot), number=NUMBER)
+        decode = timeit.timeit(lambda: serializer.loads(data), number=NUMBER)
+        # Lazy trace reading only the stack trace
+        lazy = timeit.timeit(
+            lambda: Trace.lazy(serializer.split(data), serializer.decode).stack_trace,
+            number=NUMBER)
+        print "%-12s %6d bytes  encode %7.2f us  decode %7.2f us  stack only %7.2f us" % (
+            name,
+            len(data),
+            encode / NUMBER * 1e6,
+            decode / NUMBER * 1e6,
+            lazy / NUMBER * 1e6)
+
+
+if __name__ == '__main__':
+    run()
@@ -9,27 +9,42 @@ __version__ = '0.3.3'
 
 # System
 # ~~~~~~
-import json
 import logging
 import os
-import subprocess
+import sys
+import threading
+import time
+import warnings
+import weakref
 
 # Dependency
 # ~~~~~~~~~~
 from flask import Flask
+from flask import Response
+from flask import current_app
 from flask import g
 from flask import jsonify
 from flask import request
-from flask import _app_ctx_stack as stack
 from werkzeug.exceptions import *  # NOQA
 from werkzeug.exceptions import default_exceptions
+from werkzeug.utils import import_string
 
 # Module Extension
 # ~~~~~~~~~~~~~~~~
 from exceptions import handle_http_exception
+from config import Config
+from logger import JSONFormatter
+from logger import LogListener
 from logger import add_logger
 from logger import log_exception
-from trace import Tracer
+from logger import log_suppressed
+from metrics import CONTENT_TYPE
+from metrics import Timings
+from sink import get_sink
+from state import LogExState
+from throttle import Throttle
+from trace import LIMITS
+from trace import serializers
 
 # Defaults
 # ~~~~~~~~
@@ -39,10 +54,18 @@ from defaults import __trace_codes__
 from defaults import __log_codes__
 from defaults import __handlers__
 from defaults import __loggers__
+from defaults import __plugins__
+from defaults import plugin_for
 
 
-class LogEx():
-    """LogEx Extension Class."""
+class LogEx(object):
+    """
+    LogEx Extension Class.
+
+    Settings are kept on the extension, the resources built from them for each application
+    live in `app.extensions['logex']` and are resolved from the current application, so one
+    instance can serve several applications.
+    """
 
     def __init__(self,
                  app=None,
@@ -51,8 +74,14 @@ class LogEx():
                  handlers=None,
                  loggers=None,
                  log_format=__log_format__,
+                 log_json=False,
                  log_codes=__log_codes__,
-                 trace_codes=__trace_codes__):
+                 log_queue=False,
+                 log_sink=None,
+                 log_throttle=None,
+                 plugins=None,
+                 trace_codes=__trace_codes__,
+                 trace_throttle=None):
         """
         Initialize LogEx Instance.
 
@@ -70,27 +99,55 @@ class LogEx():
             Optional with default mapping exceptions to names of loggers.
         log_format : logging.Formatter
             Optional logging format, defaulted is flask_logex.logger.log_format.
+        log_json : bool
+            Log each error as one compact JSON object with flask_logex.logger.JSONFormatter,
+            replacing log_format.
         log_codes : list
             List of codes which when encountered should trigger logging.
+        log_queue : bool
+            Write log files from a listener thread instead of the request thread.
+        log_sink : dict
+            Optional keyword arguments of flask_logex.sink.LogSink, the size, age and backups
+            of rotated log files and the buffering of writes. Applications logging to the same
+            LOG_PATH share the sink created by the first of them.
+        log_throttle : flask_logex.throttle.Throttle
+            Optional sampling and rate limits of logged errors.
+        plugins : list
+            Names of integrations in flask_logex.defaults to activate, others are activated
+            when their package is already imported or their exceptions are first handled.
         trace_codes : list
             List of codes that set traces when encountered.
+        trace_throttle : flask_logex.throttle.Throttle
+            Optional sampling and rate limits of traced errors.
         """
         # Log
-        self.log_format = log_format
+        self.log_format = JSONFormatter() if log_json else log_format
+        self.log_json = log_json
         self.log_codes = log_codes
-        self.loggers = __loggers__
+        self.log_queue = log_queue
+        self.log_sink = log_sink or {}
+        self.log_throttle = log_throttle or Throttle()
+        self.loggers = dict(__loggers__)
         if loggers:
             self.loggers.update(loggers)
         # Exception Handlers
-        self.handlers = __handlers__
+        self.handlers = dict(__handlers__)
         if handlers:
             self.handlers.update(handlers)
+        # Integrations
+        self.plugins = plugins or []
+        self._enabled = set()
+        self._plugins_lock = threading.Lock()
         # Trace
-        self.cache_config = cache_config
+        self._cache_config = cache_config
         self.trace_codes = trace_codes
-        # Application
+        self.trace_throttle = trace_throttle or Throttle()
+        # Stage timings
+        self.timings = Timings()
+        # Application, states of every initialized application
         self.app = app
         self._api = api
+        self._states = weakref.WeakSet()
         if self.app is not None:
             self.init_app(app, api, cache_config)
 
@@ -105,76 +162,236 @@ class LogEx():
         api : flask_restful.Api or list
             Optional Flask-RESTful Api or list of Api's.
         """
-        self.app = app
-        if api:
-            self._api = api
-        if cache_config:
-            self.cache_config = cache_config
+        self.check_app(app)
+        api = api or self._api
+        if api is not None and type(api) is not list:
+            api = [api]
+        state = LogExState(self, app, api)
+        app.extensions['logex'] = state
+        self._states.add(state)
         self.init_cache(app, cache_config)
-        self.init_settings()
-        self.init_logs()
-        self.configure_exceptions()
+        self.init_settings(app)
+        self.init_logs(app)
+        self.init_plugins(app)
+        self.init_dispatch(app)
+        self.configure_exceptions(app)
 
-    def check_app(self):
+    def check_app(self, app=None):
         """App property check."""
-        if self.app is None:
+        app = app or self.app
+        if app is None:
             raise AttributeError(
                 "Logex is not initialized, run init_app"
             )
-        if type(self.app) is not Flask:
+        if type(app) is not Flask:
             raise AttributeError(
                 "App is not flask.Flask"
             )
 
+    def get_state(self, app=None):
+        """State of an application, the current application by default."""
+        if app is None:
+            app = current_app._get_current_object() if current_app else self.app
+        self.check_app(app)
+        try:
+            return app.extensions['logex']
+        except KeyError:
+            raise AttributeError("Logex is not initialized for %s, run init_app" % app.name)
+
+    @property
+    def state(self):
+        """State of the current application."""
+        return self.get_state()
+
     @property
     def api(self):
-        """Override property to conver to list of flask_restful.Api."""
-        if self._api is None:
-            return self._api
-        if type(self._api) is not list:
-            self._api = [self._api]
-        return self._api
-
-    def init_settings(self):
+        """List of flask_restful.Api of the current application."""
+        return self.state.api
+
+    @property
+    def cache_config(self):
+        """Resolved cache config of the current application, the passed one before init_app."""
+        try:
+            return self.state.cache_config
+        except (AttributeError, RuntimeError):
+            return self._cache_config
+
+    @cache_config.setter
+    def cache_config(self, cache_config):
+        self._cache_config = cache_config
+
+    @property
+    def config(self):
+        return self.state.config
+
+    @property
+    def logs(self):
+        return self.state.logs
+
+    @property
+    def log_listener(self):
+        return self.state.log_listener
+
+    @property
+    def metrics(self):
+        return self.state.metrics
+
+    @property
+    def user_agents(self):
+        return self.state.user_agents
+
+    @property
+    def ENVIRONMENT(self):
+        return self.state.ENVIRONMENT
+
+    @property
+    def LOG_PATH(self):
+        return self.state.LOG_PATH
+
+    @property
+    def LOG_LEVEL(self):
+        return self.state.LOG_LEVEL
+
+    def init_settings(self, app=None):
         """Initialize settings from environment variables."""
-        self.check_app()
-        self.ENVIRONMENT = os.environ.get('ENVIRONMENT', 'local')
-        self.LOG_PATH = os.environ.get("LOG_PATH", "./logs/")
-        self.LOG_LEVEL = os.environ.get("LOG_LEVEL", logging.INFO)
+        state = self.get_state(app)
+        state.ENVIRONMENT = os.environ.get('ENVIRONMENT', 'local')
+        state.LOG_PATH = os.environ.get("LOG_PATH", "./logs/")
+        state.LOG_LEVEL = os.environ.get("LOG_LEVEL", logging.INFO)
         # Log Directory
-        if not os.path.isdir(self.LOG_PATH):
+        if not os.path.isdir(state.LOG_PATH):
             try:
-                subprocess.call(
-                    ['mkdir', '-p', self.LOG_PATH]
-                )
-            except Exception as e:
-                raise StandardError(str(e))
+                os.makedirs(state.LOG_PATH)
+            except OSError as e:
+                # Created concurrently by another worker
+                if not os.path.isdir(state.LOG_PATH):
+                    raise StandardError(str(e))
 
-    def init_logs(self):
+    def init_logs(self, app=None):
         """Configure logging on the flask application."""
-        self.check_app()
+        state = self.get_state(app)
         # Environment controlled loggging level
-        self.LOG_LEVEL = logging.INFO
-        if self.ENVIRONMENT == 'development':
-            self.LOG_LEVEL = logging.WARNING
-        elif self.ENVIRONMENT == 'production':
-            self.LOG_LEVEL = logging.ERROR
-
-        self.logs = {}
+        state.LOG_LEVEL = logging.INFO
+        if state.ENVIRONMENT == 'development':
+            state.LOG_LEVEL = logging.WARNING
+        elif state.ENVIRONMENT == 'production':
+            state.LOG_LEVEL = logging.ERROR
+
+        state.logs = {}
+        state.sink = get_sink(state.LOG_PATH, **self.log_sink)
+        if self.log_queue and state.log_listener is None:
+            state.log_listener = LogListener(metrics=state.metrics)
         # Loggers
         loggers = self.loggers.values()
-        loggers.append(self.app.logger_name)
+        loggers.append(state.app.logger_name)
         for log_name in loggers:
-            logger = add_logger(log_name, self)
-            self.logs[log_name] = logger
+            state.logger(log_name)
+
+    def init_plugins(self, app=None):
+        """Activate the requested, eager and already imported integrations."""
+        for name in self.plugins:
+            if name not in __plugins__:
+                raise ValueError("%s is not a LogEx integration" % name)
+            if not self.enable_plugin(name):
+                raise ImportError("%s integration requires the %s package" % (
+                    name, __plugins__[name].package))
+        for name, plugin in __plugins__.items():
+            if plugin.eager or plugin.package in sys.modules:
+                self.enable_plugin(name)
+
+    def enable_plugin(self, name):
+        """Register the loggers and handlers of an integration, False without its package."""
+        if name in self._enabled:
+            return True
+        # Also called from requests, the first exception of a package activates its plugin
+        with self._plugins_lock:
+            if name in self._enabled:
+                return True
+            loaded = __plugins__[name].activate()
+            if loaded is None:
+                return False
+            loggers, handlers = loaded
+            # Applications initialized before the activation route the plugin's exceptions too
+            self.add_errorhandlers([exc_type for exc_type in handlers
+                                    if issubclass(exc_type, Exception)])
+            self.handlers.update(handlers)
+            for exc_type, log_name in loggers.items():
+                self.loggers[exc_type] = log_name
+                self.add_logs(log_name)
+            self.reset_dispatch()
+            self._enabled.add(name)
+        return True
+
+    def add_logs(self, log_name):
+        """Add the logger to every initialized application missing it."""
+        for state in list(self._states):
+            state.logger(log_name)
+
+    def init_dispatch(self, app=None):
+        """Freeze the settings and resolve every registered exception up front."""
+        state = self.get_state(app)
+        self.freeze(state)
+        for exc_type in set(self.handlers.keys()) | set(self.loggers.keys()):
+            state.config.resolve(exc_type)
+
+    def freeze(self, state):
+        """Build the config read by requests of an application from the current settings."""
+        state.config = Config(self.handlers,
+                              self.loggers,
+                              self.log_codes,
+                              self.trace_codes,
+                              self.log_json,
+                              state.app.logger_name)
+
+    def reset_dispatch(self):
+        """Rebuild the configs, required after changing handlers, loggers or codes."""
+        for state in list(self._states):
+            self.freeze(state)
+
+    def dispatch(self, exc_type, state=None):
+        """Handler and logger name of an exception type, see flask_logex.config.Config."""
+        state = state or self.state
+        config = state.config
+        try:
+            return config.dispatch[exc_type]
+        except KeyError:
+            pass
+        # First exception of an integration's package activates it
+        plugin = plugin_for(exc_type)
+        if plugin is not None and plugin.name not in self._enabled:
+            if self.enable_plugin(plugin.name):
+                config = state.config
+        return config.resolve(exc_type)
+
+    def register_handler(self, exc_type, handler=None):
+        """Add an exception handler after initialization, also while serving requests."""
+        self.add_errorhandlers([exc_type])
+        self.handlers[exc_type] = handler
+        self.reset_dispatch()
+
+    def add_errorhandlers(self, exc_types):
+        """Route exceptions to jsonify_error in every initialized application."""
+        for state in list(self._states):
+            app = state.app
+            # app.errorhandler refuses registrations after the first request in debug mode
+            spec = app.error_handler_spec.setdefault(None, {})
+            for exc_type in exc_types:
+                exc_class, code = app._get_exc_class_and_code(exc_type)
+                spec.setdefault(code, {})[exc_class] = self.jsonify_error
+
+    def register_logger(self, exc_type, log_name):
+        """Add a logger for an exception after initialization."""
+        self.loggers[exc_type] = log_name
+        self.add_logs(log_name)
+        self.reset_dispatch()
 
     def init_cache(self, app, cache_config):
         """Create the cache based on passed cache config values."""
-        self.check_app()
+        state = self.get_state(app)
         # Use app config by default, otherwise supply cache_config
         config = app.config.copy()
-        if self.cache_config:
-            config.update(self.cache_config)
+        if self._cache_config:
+            config.update(self._cache_config)
         if cache_config:
             config.update(cache_config)
 
@@ -186,18 +403,47 @@ class LogEx():
         # Simple + Filesystem
         config.setdefault('LOGEX_CACHE_DIR', None)
         config.setdefault('LOGEX_CACHE_THRESHOLD', 500)
+        # LRU
+        config.setdefault('LOGEX_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        # Segment, append-only files in LOGEX_CACHE_DIR
+        config.setdefault('LOGEX_CACHE_SEGMENT_BYTES', 64 * 1024 * 1024)
+        config.setdefault('LOGEX_CACHE_SEGMENT_MAX_AGE', 86400)
+        # SQLite, LOGEX_CACHE_DIR/traces.sqlite by default
+        config.setdefault('LOGEX_CACHE_SQLITE_PATH', None)
+        # Tiered, local LRU over a remote backend
+        config.setdefault('LOGEX_CACHE_TIERED_BACKEND', 'redis')
+        config.setdefault('LOGEX_CACHE_TIERED_MAX_BYTES', 8 * 1024 * 1024)
+        config.setdefault('LOGEX_CACHE_TIERED_TIMEOUT', 60)
         # Redis
         config.setdefault('LOGEX_CACHE_REDIS_HOST', None)
         config.setdefault('LOGEX_CACHE_REDIS_PORT', 6379)
         config.setdefault('LOGEX_CACHE_REDIS_URL', None)
         config.setdefault('LOGEX_CACHE_REDIS_DB', None)
         config.setdefault('LOGEX_CACHE_REDIS_PASSWORD', None)
+        config.setdefault('LOGEX_CACHE_REDIS_MAX_CONNECTIONS', None)
         config.setdefault('LOGEX_CACHE_KEY_PREFIX', None)
         # Options
         config.setdefault('LOGEX_CACHE_DEFAULT_TIMEOUT', 300)
         config.setdefault('LOGEX_CACHE_OPTIONS', None)
         config.setdefault('LOGEX_CACHE_ARGS', [])
         config.setdefault('LOGEX_CACHE_NO_NULL_WARNING', False)
+        # Trace format
+        config.setdefault('LOGEX_TRACE_FORMAT', 'legacy')
+        config.setdefault('LOGEX_TRACE_COMPRESS', False)
+        # Byte limits of the captured trace fields, 0 for no limit
+        config.setdefault('LOGEX_TRACE_MAX_STACK_TRACE', LIMITS['stack_trace'])
+        config.setdefault('LOGEX_TRACE_MAX_HEADERS', LIMITS['request_headers'])
+        config.setdefault('LOGEX_TRACE_MAX_REQUEST_BODY', LIMITS['request_body'])
+        config.setdefault('LOGEX_TRACE_MAX_RESPONSE_BODY', LIMITS['response_body'])
+        # Trace grouping by fingerprint
+        config.setdefault('LOGEX_TRACE_FINGERPRINT', False)
+        config.setdefault('LOGEX_TRACE_OCCURRENCES', 100)
+        # Background trace writer
+        config.setdefault('LOGEX_TRACE_ASYNC', False)
+        config.setdefault('LOGEX_TRACE_QUEUE_SIZE', 1000)
+        config.setdefault('LOGEX_TRACE_QUEUE_POLICY', 'drop')
+        config.setdefault('LOGEX_TRACE_QUEUE_TIMEOUT', 1.0)
+        config.setdefault('LOGEX_TRACE_BATCH_SIZE', 100)
 
         cache_import = config['LOGEX_CACHE_TYPE']
         if '.' not in cache_import:
@@ -206,9 +452,14 @@ class LogEx():
                 cache_obj = getattr(caches, cache_import)
             except AttributeError:
                 raise ImportError("%s is not a valid FlaskCache backend" % (
-                                  import_me))  # NOQA
+                                  cache_import))
         else:
-            cache_obj = import_string(import_me)  # NOQA
+            cache_obj = import_string(cache_import)
+
+        if config['LOGEX_TRACE_FORMAT'] not in serializers:
+            raise ValueError("%s is not a valid trace format" % config['LOGEX_TRACE_FORMAT'])
+        if config['LOGEX_TRACE_COMPRESS'] and config['LOGEX_TRACE_FORMAT'] == 'legacy':
+            raise ValueError("LOGEX_TRACE_COMPRESS requires the binary trace format")
 
         cache_args = config['LOGEX_CACHE_ARGS'][:]
         cache_options = {'default_timeout': config['LOGEX_CACHE_DEFAULT_TIMEOUT']}
@@ -216,94 +467,123 @@ class LogEx():
         if config['LOGEX_CACHE_OPTIONS']:
             cache_options.update(config['LOGEX_CACHE_OPTIONS'])
 
-        self.cache_config = config
-        self.cache_args = cache_args
-        self.cache_options = cache_options
-        self.cache_obj = cache_obj
+        state.cache_config = config
+        state.cache_args = cache_args
+        state.cache_options = cache_options
+        state.cache_obj = cache_obj
+        # Rebuilt on next access with the new configuration
+        state.reset_cache()
 
-    def teardown(self, exception):
-        ctx = stack.top
-        if hasattr(ctx, 'logex_tracer'):
-            ctx.logex_tracer = None
+    @property
+    def cache(self):
+        """Trace cache of the current application, see flask_logex.state.LogExState."""
+        return self.state.cache
 
     @property
     def tracer(self):
-        ctx = stack.top
-        if ctx is not None:
-            if not hasattr(ctx, 'logex_tracer'):
-                ctx.logex_tracer = Tracer(
-                    self.cache_obj(
-                        self.app,
-                        self.cache_config,
-                        self.cache_args,
-                        self.cache_options)
-                )
-            return ctx.logex_tracer
-
-    def configure_exceptions(self):
+        """Tracer of the current application reusing its process wide cache client."""
+        return self.state.tracer
+
+    def flush(self, timeout=None):
+        """
+        Wait for queued traces and log records of every application to be written, after
+        logging the summaries of all suppressed events.
+        """
+        states = list(self._states)
+        if states:
+            self.log_pending(states[0], force=True)
+        for state in states:
+            state.flush(timeout)
+
+    def teardown(self, exception):
+        """Deprecated, the tracer is shared by the process and no longer kept per app context."""
+        warnings.warn("LogEx.teardown is deprecated and does nothing", DeprecationWarning,
+                      stacklevel=2)
+
+    def metrics_view(self):
+        """View rendering the metrics in the Prometheus text format."""
+        return Response(self.metrics.render(), content_type=CONTENT_TYPE)
+
+    def mount_metrics(self, rule='/metrics', app=None):
+        """Mount the metrics view on the application, or a blueprint, at rule."""
+        app = app or self.state.app
+        app.add_url_rule(rule, 'logex_metrics', self.metrics_view)
+
+    def configure_exceptions(self, app=None):
         """Configure exception handler for Flask and Flask-Restful."""
-        self.check_app()
+        state = self.get_state(app)
+        app = state.app
         # Add LogEx process_response to after request
-        self.app.after_request_funcs.setdefault(None, []).append(self.process_response)
+        app.after_request_funcs.setdefault(None, []).append(self.process_response)
         # Default exceptions provided by werkzeug
         for code in default_exceptions:
-            self.app.errorhandler(code)(self.jsonify_error)
+            app.errorhandler(code)(self.jsonify_error)
             # Register errorhandler for Blueprints
-            if self.app.blueprints:
-                for bp_name in self.app.blueprints:
-                    bp = self.app.blueprints[bp_name]
+            if app.blueprints:
+                for bp_name in app.blueprints:
+                    bp = app.blueprints[bp_name]
                     bp.errorhandler(code)(self.jsonify_error)
         # Custom exceptions provided by handlers
         for err in self.handlers.keys():
             if issubclass(err, Exception):
-                self.app.errorhandler(err)(self.jsonify_error)
+                app.errorhandler(err)(self.jsonify_error)
         # Flask-RESTful handle_error override
-        if self.api:
-            for api in self.api:
+        if state.api:
+            for api in state.api:
                 api.handle_error = self.jsonify_error
 
     def process_response(self, response):
-        """Handler for the Flask response hook to add in request/response tracing"""
-        # Check for successfulk, empty, and irrelevant responses
-        try:
-            response_data = json.loads(response.data)
-        except:
-            return response
-        if not response_data:
-            return response
-        if 'error' not in response_data:
+        """Handler for the Flask response hook to log errors traced by handle_error"""
+        # Errors are recorded by handle_error, successful responses exit here
+        # without the body being parsed or buffered
+        error = g.pop("_logex_error", None)
+        if error is None:
             return response
         if not hasattr(g, "_logex_exception"):
             return response
 
-        trace_id = None
-        code = response_data['error']['code']
-        message = response_data['error']['message']
+        state = self.state
+        config = state.config
+        code = error['code']
+        message = error['message']
+        trace_id = error.get('id')
+        exc_type = type(g._logex_exception)
 
-        if self.tracer and code in self.trace_codes:
-            # Trace creation and dump
-            try:
-                trace_id = self.tracer.set(request, response)
-                response_data = json.loads(response.data)
-                response_data['error']['id'] = trace_id
-                response.data = json.dumps(response_data)
-            except:
-                return response
-
-        if code in self.log_codes:
-            _loggers = self.loggers.keys()
-            exc_type = type(g._logex_exception)
+        if code in config.log_codes:
             # Log in custom logger, otherwise app.logger
-            if issubclass(exc_type, tuple(_loggers)):
-                key = [i for i in _loggers if issubclass(exc_type, i)][0]
-                logger_name = self.loggers[key]
-                log_exception(logger_name, message, trace_id)
+            logger = state.logger(self.dispatch(exc_type, state)[1])
+            logged, suppressed = self.log_throttle.check(code, exc_type)
+            if suppressed:
+                log_suppressed(logger, "logs", code, exc_type, suppressed,
+                               structured=config.log_json)
+            if logged:
+                start = time.time()
+                log_exception(logger, message, trace_id, code,
+                              structured=config.log_json, user_agents=state.user_agents)
+                self.timings.emit('log_exception', start)
+                state.metrics.observe('logex_log_seconds', time.time() - start)
+                state.metrics.inc('logex_logs_total', code)
             else:
-                log_exception(self.app.logger_name, message, trace_id)
+                state.metrics.inc('logex_dropped_total', 'log', 'throttled')
+        self.log_pending(state)
         return response
 
+    def log_pending(self, state=None, force=False):
+        """Log the summaries of suppressed logs and traces due without a later event."""
+        state = state or self.state
+        config = state.config
+        for kind, throttle in (("logs", self.log_throttle), ("traces", self.trace_throttle)):
+            for code, exc_type, count in throttle.pending(force):
+                if kind == "logs":
+                    logger_name = self.dispatch(exc_type, state)[1]
+                else:
+                    logger_name = config.logger_name
+                log_suppressed(state.logger(logger_name), kind, code, exc_type, count,
+                               structured=config.log_json)
+
     def handle_error(self, e):
         """Handle error defaulted values and runs through handlers."""
+        state = self.state
         g._logex_exception = e
         code = e.code if hasattr(e, "code") else 500
         message = str(e)
@@ -314,14 +594,50 @@ class LogEx():
             type=error_type
         )
         # Default error handler
+        start = self.timings.clock()
         http_error = handle_http_exception(e)
         for key, value in http_error.iteritems():
             error[key] = value
+        self.timings.emit('handle_http_exception', start)
         # Run error through custom error handlers to override response
-        if type(e) in self.handlers and self.handlers[type(e)]:
-            error = self.handlers[type(e)](e)
+        handler = self.dispatch(type(e), state)[0]
+        if handler:
+            start = self.timings.clock()
+            error = handler(e)
+            self.timings.emit('handler', start)
+        state.metrics.inc('logex_errors_total', error['code'], error.get('type'),
+                          request.endpoint or '')
+        # Traced before serialization, the trace id is part of the error
+        if state.tracer and error['code'] in state.config.trace_codes:
+            self.trace_error(e, error, state)
+        # Recorded for process_response to skip non-error responses
+        g._logex_error = error
         return error
 
+    def trace_error(self, e, error, state=None):
+        """Trace the error structure and add the trace id to it."""
+        state = state or self.state
+        code = error['code']
+        exc_type = type(e)
+        traced, suppressed = self.trace_throttle.check(code, exc_type)
+        if suppressed:
+            log_suppressed(state.logger(state.config.logger_name), "traces", code, exc_type,
+                           suppressed, structured=state.config.log_json)
+        if not traced:
+            state.metrics.inc('logex_dropped_total', 'trace', 'throttled')
+            return
+        start = time.time()
+        try:
+            trace_id = state.tracer.set_error(request, error, exc_type)
+        except Exception:
+            state.metrics.inc('logex_dropped_total', 'trace', 'error')
+            return
+        if trace_id is None:
+            # Dropped by the trace writer, which counts it
+            return
+        state.metrics.observe('logex_trace_seconds', time.time() - start)
+        state.metrics.inc('logex_traces_total', code)
+
     def jsonify_error(self, e):
         """Separate jsonify and handle_error."""
         error = self.handle_error(e)
@@ -5,11 +5,230 @@ Cache backends to use with tracing enabled.
 :license: All rights reserved
 """
 
+import os
 import pickle  # NOQA
+import re
+import sys
+import threading
+from time import time
+from werkzeug.utils import import_string
 from werkzeug.contrib.cache import (BaseCache, NullCache, SimpleCache, MemcachedCache,  # NOQA
                                     GAEMemcachedCache, RedisCache, FileSystemCache)     # NOQA
 
 
+# Counts and occurrence slots of fingerprints, written by every node
+_shared = re.compile(r':(count|t\d+)$')
+
+
+def _shared_key(key):
+    return _shared.search(key) is not None
+
+
+# Fields of the linked entries of LRUCache
+PREV, NEXT, KEY, VALUE, EXPIRES, SIZE = range(6)
+
+
+class LRUCache(BaseCache):
+    """
+    Thread-safe in-process cache bounded by the total size of its values.
+
+    Least recently used entries are evicted once the values stored exceed `max_bytes`,
+    entries also expire after their timeout. Entries are kept in a circular doubly linked
+    list ordered by use, lookups and writes are O(1).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, 0, 0]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, basestring):
+            return len(value)
+        return sys.getsizeof(value)
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout > 0:
+            return time() + timeout
+        return 0
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        del self._entries[link[KEY]]
+        self.size -= link[SIZE]
+
+    def _lookup(self, key):
+        """Link of a live key, moved to the most recently used end."""
+        link = self._entries.get(key)
+        if link is None:
+            return None
+        if link[EXPIRES] and link[EXPIRES] <= time():
+            self._unlink(link)
+            return None
+        root = self._root
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = root
+        return link
+
+    def _insert(self, key, value, expires):
+        """Store a value, False without evicting anything when it exceeds max_bytes."""
+        link = self._entries.get(key)
+        if link is not None:
+            self._unlink(link)
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return False
+        root = self._root
+        last = root[PREV]
+        link = [last, root, key, value, expires, size]
+        last[NEXT] = root[PREV] = self._entries[key] = link
+        self.size += size
+        # Evict least recently used
+        while self.size > self.max_bytes and root[NEXT] is not root:
+            self._unlink(root[NEXT])
+        return True
+
+    def get(self, key):
+        with self._lock:
+            link = self._lookup(key)
+            return link[VALUE] if link is not None else None
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            return self._insert(key, value, self._expires(timeout))
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            return self._insert(key, value, self._expires(timeout))
+
+    def delete(self, key):
+        with self._lock:
+            link = self._entries.get(key)
+            if link is None:
+                return False
+            self._unlink(link)
+        return True
+
+    def has(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            link = self._lookup(key)
+            if link is None:
+                value = delta
+                self._insert(key, value, self._expires(None))
+            else:
+                value = link[VALUE] + delta
+                self._insert(key, value, link[EXPIRES])
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def clear(self):
+        with self._lock:
+            root = self._root
+            root[:] = [root, root, None, None, 0, 0]
+            self._entries.clear()
+            self.size = 0
+        return True
+
+
+class TieredCache(BaseCache):
+    """
+    Local cache layered over a remote one.
+
+    Writes go through to both caches, reads are served locally when possible and fill the
+    local cache from the remote one otherwise. Keys matched by `shared`, by default the
+    fingerprint counts and occurrence slots updated by every node, always go to the remote
+    cache.
+    """
+
+    def __init__(self, local, remote, default_timeout=300, shared=None):
+        BaseCache.__init__(self, default_timeout)
+        self.local = local
+        self.remote = remote
+        self.shared = shared or _shared_key
+
+    def get(self, key):
+        if self.shared(key):
+            return self.remote.get(key)
+        value = self.local.get(key)
+        if value is None:
+            value = self.remote.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def get_many(self, *keys):
+        local = [key for key in keys if not self.shared(key)]
+        values = dict(zip(local, self.local.get_many(*local))) if local else {}
+        missing = [key for key in keys if values.get(key) is None]
+        if missing:
+            found = dict(zip(missing, self.remote.get_many(*missing)))
+            for key, value in found.items():
+                if value is not None and not self.shared(key):
+                    self.local.set(key, value)
+            values.update(found)
+        return [values.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        result = self.remote.set(key, value, timeout)
+        if not self.shared(key):
+            self.local.set(key, value)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        result = self.remote.set_many(mapping, timeout)
+        for key, value in mapping.items():
+            if not self.shared(key):
+                self.local.set(key, value)
+        return result
+
+    def add(self, key, value, timeout=None):
+        if not self.remote.add(key, value, timeout):
+            return False
+        if not self.shared(key):
+            self.local.set(key, value)
+        return True
+
+    def inc(self, key, delta=1):
+        # Counters are shared, the remote value is authoritative
+        self.local.delete(key)
+        return self.remote.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self.local.delete(key)
+        return self.remote.dec(key, delta)
+
+    def delete(self, key):
+        self.local.delete(key)
+        return self.remote.delete(key)
+
+    def has(self, key):
+        return self.local.has(key) or self.remote.has(key)
+
+    def clear(self):
+        self.local.clear()
+        return self.remote.clear()
+
+
 def null(app, config, args, kwargs):
     return NullCache()
 
@@ -19,6 +238,11 @@ def simple(app, config, args, kwargs):
     return SimpleCache(*args, **kwargs)
 
 
+def lru(app, config, args, kwargs):
+    kwargs.update(dict(max_bytes=config['LOGEX_CACHE_MAX_BYTES']))
+    return LRUCache(*args, **kwargs)
+
+
 def memcached(app, config, args, kwargs):
     args.append(config['LOGEX_CACHE_MEMCACHED_SERVERS'])
     kwargs.update(dict(key_prefix=config['LOGEX_CACHE_KEY_PREFIX']))
@@ -36,6 +260,24 @@ def filesystem(app, config, args, kwargs):
     return FileSystemCache(*args, **kwargs)
 
 
+def segment(app, config, args, kwargs):
+    # Imported on use, segments require fcntl
+    from segments import SegmentCache
+    args.insert(0, config['LOGEX_CACHE_DIR'])
+    kwargs.update(dict(segment_bytes=config['LOGEX_CACHE_SEGMENT_BYTES'],
+                       max_age=config['LOGEX_CACHE_SEGMENT_MAX_AGE']))
+    return SegmentCache(*args, **kwargs)
+
+
+def sqlite(app, config, args, kwargs):
+    from sqlite import SQLiteCache
+    path = config['LOGEX_CACHE_SQLITE_PATH']
+    if path is None:
+        path = os.path.join(config['LOGEX_CACHE_DIR'] or '.', 'traces.sqlite')
+    args.insert(0, path)
+    return SQLiteCache(*args, **kwargs)
+
+
 def redis(app, config, args, kwargs):
     kwargs.update(dict(
         host=config.get('LOGEX_CACHE_REDIS_HOST', 'localhost'),
@@ -53,15 +295,33 @@ def redis(app, config, args, kwargs):
     if db_number:
         kwargs['db'] = db_number
 
+    # Client backed by a connection pool shared across requests
+    try:
+        from redis import ConnectionPool, Redis
+    except ImportError:
+        return RedisCache(*args, **kwargs)
+
+    pool_options = dict(max_connections=config.get('LOGEX_CACHE_REDIS_MAX_CONNECTIONS'))
     redis_url = config.get('LOGEX_CACHE_REDIS_URL')
     if redis_url:
-        try:
-            from redis import redis_from_url
-            kwargs['host'] = redis_from_url(
-                                redis_url,
-                                db=kwargs.pop('db', None),
-                            )
-        except ImportError:
-            pass
+        pool = ConnectionPool.from_url(redis_url, db=kwargs.pop('db', 0), **pool_options)
+    else:
+        pool = ConnectionPool(host=kwargs['host'] or 'localhost',
+                              port=kwargs['port'],
+                              password=kwargs.get('password'),
+                              db=kwargs.pop('db', 0),
+                              **pool_options)
+    kwargs['host'] = Redis(connection_pool=pool)
 
     return RedisCache(*args, **kwargs)
+
+
+def tiered(app, config, args, kwargs):
+    backend = config['LOGEX_CACHE_TIERED_BACKEND']
+    factory = import_string(backend) if '.' in backend else globals()[backend]
+    if factory is tiered:
+        raise ValueError("LOGEX_CACHE_TIERED_BACKEND cannot be tiered")
+    remote = factory(app, config, args, kwargs)
+    local = LRUCache(max_bytes=config['LOGEX_CACHE_TIERED_MAX_BYTES'],
+                     default_timeout=config['LOGEX_CACHE_TIERED_TIMEOUT'])
+    return TieredCache(local, remote)
@@ -0,0 +1,63 @@
+"""
+Frozen configuration of a LogEx instance.
+
+Built by init_app from the settings of the instance and rebuilt whenever they change, the
+request path only reads the current config and never takes a lock.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+
+class FrozenDict(dict):
+    """Dict refusing changes once created."""
+
+    def _frozen(self, *args, **kwargs):
+        raise TypeError("LogEx config is frozen, change the LogEx settings instead")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _frozen
+
+
+class Config(object):
+    """Immutable handlers, loggers and codes of a LogEx instance."""
+
+    __slots__ = ('handlers', 'loggers', 'log_codes', 'trace_codes', 'log_json', 'logger_name',
+                 'dispatch')
+
+    def __init__(self, handlers, loggers, log_codes, trace_codes, log_json, logger_name):
+        setattr = object.__setattr__
+        setattr(self, 'handlers', FrozenDict(handlers))
+        setattr(self, 'loggers', FrozenDict(loggers))
+        setattr(self, 'log_codes', frozenset(log_codes))
+        setattr(self, 'trace_codes', frozenset(trace_codes))
+        setattr(self, 'log_json', log_json)
+        setattr(self, 'logger_name', logger_name)
+        # Handler and logger name per exception type, filled on first use
+        setattr(self, 'dispatch', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("LogEx config is frozen, change the LogEx settings instead")
+
+    def resolve(self, exc_type):
+        """
+        Handler and logger name of an exception type.
+
+        Both are resolved along the MRO of the exception, the most specific registered class
+        wins, loggers default to the application logger. Results are cached per type.
+        """
+        try:
+            return self.dispatch[exc_type]
+        except KeyError:
+            pass
+        handler = None
+        for cls in exc_type.__mro__:
+            if cls in self.handlers:
+                handler = self.handlers[cls]
+                break
+        logger_name = self.logger_name
+        for cls in exc_type.__mro__:
+            if cls in self.loggers:
+                logger_name = self.loggers[cls]
+                break
+        self.dispatch[exc_type] = (handler, logger_name)
+        return handler, logger_name
@@ -14,56 +14,107 @@ __log_codes__ = [422, 500, 501, 502, 503]
 __handlers__ = {}
 __loggers__ = {}
 
+#
+# Integrations with third-party packages, imported only once activated
+#
+__plugins__ = {}
+
+
+class Plugin(object):
+    """
+    Integration with a third-party package.
+
+    The package is imported by `load` when the plugin is first activated, which returns the
+    loggers and handlers of the integration keyed by exception class. Eager plugins are
+    activated by init_app whenever their package is installed.
+    """
+
+    def __init__(self, name, package, load, eager=False):
+        self.name = name
+        self.package = package
+        self.load = load
+        self.eager = eager
+        self._loaded = None
+
+    def activate(self):
+        """Loggers and handlers of the integration, None when the package is missing."""
+        if self._loaded is None:
+            try:
+                self._loaded = self.load()
+            except ImportError:
+                self._loaded = False
+        return self._loaded or None
+
+
+def register_plugin(name, package, eager=False):
+    """Decorator adding the load function of an integration to __plugins__."""
+    def decorator(load):
+        __plugins__[name] = Plugin(name, package, load, eager)
+        return load
+    return decorator
+
+
+def plugin_for(exc_type):
+    """Plugin of the package an exception class is defined in, if any."""
+    package = (exc_type.__module__ or '').split('.', 1)[0]
+    for plugin in __plugins__.values():
+        if plugin.package == package:
+            return plugin
+
+
 #
 # Custom Boto Logging + Exception Handler
 #
-try:
+def handle_boto_error(e):
+    """Custom boto error handler for when boto is used."""
+    from boto.exception import BotoClientError
+    from boto.exception import BotoServerError
+    error = {}
+    if isinstance(e, (BotoClientError, BotoServerError)):
+        error["code"] = 500
+        error["type"] = "boto_error"
+        error["message"] = "Boto exception caught!"
+        if getattr(e, "reason", None):
+            error["message"] = str(e.reason)
+        if getattr(e, "message", None):
+            error["message"] = str(e.message)
+    return error
+
+
+@register_plugin("boto", "boto")
+def load_boto():
+    """Handling and logging for all base error classes within boto."""
     from boto.exception import BotoClientError
     from boto.exception import BotoServerError
     from boto.exception import JSONResponseError
+    errors = (BotoClientError, BotoServerError, JSONResponseError)
+    return dict.fromkeys(errors, "boto"), dict.fromkeys(errors, handle_boto_error)
 
-    def handle_boto_error(e):
-        """Custom boto error handler for when boto is used."""
-        error = {}
-        if issubclass(e, BotoClientError):
-            error["code"] = 500
-            error["type"] = "boto_error"
-            error["message"] = "Boto exception caught!"
-            if hasattr("reason", e):
-                error["message"] = str(e.reason)
-            if hasattr("message", e):
-                error["message"] = str(e.message)
-    # Add logger and exception handler to logex default
-    # Handling for all base error classes within boto
-    __loggers__[BotoClientError] = "boto"
-    __loggers__[BotoServerError] = "boto"
-    __loggers__[JSONResponseError] = "boto"
-    __handlers__[BotoClientError] = handle_boto_error
-    __handlers__[BotoServerError] = handle_boto_error
-    __handlers__[JSONResponseError] = handle_boto_error
-except ImportError:
-    pass
 
 #
 # Webargs + Marshmallow Logging + Exception Handling
 #
-try:
-    from webargs.flaskparser import parser
+class ValidationError(HTTPException):
+    """Validation excetion written specific to Flask-LogEx."""
+    code = 400
+
+    def __init__(self, e):
+        HTTPException.__init__(self)
+        self.data = {"message": e.message}
 
-    class ValidationError(HTTPException):
-        """Validation excetion written specific to Flask-LogEx."""
-        code = 400
-        data = {}
 
-        def __init__(self, e):
-            self.data["message"] = e.message
+def handle_validation_error(e):
+    """Webargs validation handling."""
+    raise ValidationError(e)
 
-    @parser.error_handler
-    def handle_validation_error(e):
-        """Webargs validation handling."""
-        raise ValidationError(e)
-except ImportError:
-    pass
+
+# Eager, webargs aborts with werkzeug exceptions that never activate it when first handled
+@register_plugin("webargs", "webargs", eager=True)
+def load_webargs():
+    """Raise ValidationError from the webargs Flask parser."""
+    from webargs.flaskparser import parser
+    parser.error_handler(handle_validation_error)
+    return {}, {}
 
 
 # Combining Flask Status Codes and werkzeug.exceptions.default_exceptions
@@ -8,9 +8,18 @@ that is passed.
 :license: All rights reserved
 """
 
+import atexit
+import json
 import logging
+import os
 import sys
+import threading
+import time
+import weakref
+import Queue
+from collections import OrderedDict
 from flask import request
+from werkzeug.useragents import UserAgent
 
 
 ''' Define the logging format '''
@@ -24,6 +33,78 @@ log_format = (
 )
 
 
+# Compact encoder shared by every structured record
+_encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formatter writing each record as one compact JSON object.
+
+    Records logged with a dict message have its fields merged into the object, along with
+    the time, level and logger name of the record and the stack of its exception.
+    """
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            event = dict(record.msg)
+        else:
+            event = {'message': record.getMessage()}
+        event['time'] = record.created
+        event['level'] = record.levelname
+        event['logger'] = record.name
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            event['stack'] = record.exc_text
+        return _encoder.encode(event)
+
+
+class UserAgentCache(object):
+    """
+    Bounded memo of user agent strings parsed by werkzeug.
+
+    Parsed `(platform, browser, version)` are kept for the `maxsize` most recently used
+    strings. Lookups are counted as hits and misses, also in the optional metrics.
+    """
+
+    def __init__(self, maxsize=1024, metrics=None):
+        self.maxsize = maxsize
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self._parsed = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        """Share of lookups served from the memo."""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def parse(self, string):
+        """Platform, browser and version of the user agent string."""
+        with self._lock:
+            parsed = self._parsed.pop(string, None)
+            if parsed is not None:
+                self._parsed[string] = parsed
+                self.hits += 1
+        if parsed is not None:
+            if self.metrics is not None:
+                self.metrics.inc('logex_user_agent_cache_total', 'hit')
+            return parsed
+        user_agent = UserAgent(string)
+        parsed = (user_agent.platform, user_agent.browser, user_agent.version)
+        with self._lock:
+            self.misses += 1
+            self._parsed[string] = parsed
+            while len(self._parsed) > self.maxsize:
+                self._parsed.popitem(last=False)
+        if self.metrics is not None:
+            self.metrics.inc('logex_user_agent_cache_total', 'miss')
+        return parsed
+
+
 def _should_log_for(app, mode):
     policy = app.config['LOGGER_HANDLER_POLICY']
     if policy == mode or policy == 'always':
@@ -31,44 +112,220 @@ def _should_log_for(app, mode):
     return False
 
 
+class QueueHandler(logging.Handler):
+    """Handler passing records to a LogListener instead of writing them."""
+
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
+
+    def prepare(self, record):
+        """Resolve the message and exception text while still on the logging thread."""
+        # Structured events stay dicts for the JSONFormatter
+        if not isinstance(record.msg, dict):
+            record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.listener.put(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+# Listeners of this process, stopped once at exit
+_listeners = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_listeners():
+    for listener in list(_listeners):
+        listener.stop()
+
+
+class LogListener(object):
+    """Single thread draining queued records in batches to the handlers of each logger."""
+
+    def __init__(self, maxsize=10000, batch_size=100, metrics=None):
+        self.maxsize = maxsize
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.handlers = {}
+        self.dropped = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def set_handler(self, log_name, handler):
+        """Route records of the named logger to the handler."""
+        self.handlers[log_name] = [handler]
+
+    def _start(self):
+        """Start the listener thread, restarted in forked processes."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = Queue.Queue(self.maxsize)
+            self._thread = threading.Thread(target=self._run, name="logex-log-listener")
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+            _listeners.add(self)
+
+    def put(self, record):
+        """Queue a record, returns False when it was dropped."""
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.inc('logex_dropped_total', 'log', 'queue')
+            return False
+        return True
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                self.handle(batch)
+            finally:
+                for record in batch:
+                    queue.task_done()
+            if None in batch:
+                return
+
+    def handle(self, batch):
+        """Write a batch of records, flushing each handler once."""
+        touched = set()
+        for record in batch:
+            if record is None:
+                continue
+            for handler in self.handlers.get(record.name, ()):
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+                    touched.add(handler)
+        for handler in touched:
+            handler.flush()
+
+    def flush(self, timeout=None):
+        """Wait for queued records to be written, returns False on timeout."""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return False
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=5.0):
+        """Flush queued records and stop the listener thread."""
+        _listeners.discard(self)
+        if not self.flush(timeout):
+            return
+        self.queue.put(None)
+        self._thread.join(timeout)
+        self._pid = None
+
+
 def get_logger(log_name):
     return logging.getLogger(log_name)
 
 
-def add_logger(log_name, logex):
-    """Add logger from logging.getLogger."""
-    app = logex.app
-    log_path = logex.LOG_PATH + log_name + ".log"
-    logger = get_logger(log_name)
+def add_logger(log_name, state):
+    """
+    Create the logger of a name for the application of a LogExState.
 
-    if len(logger.handlers):
-        del logger.handlers[:]
+    Loggers are kept in `state.logs` instead of the process wide registry of
+    logging.getLogger, so applications sharing logger names keep their own handlers, level
+    and debug setting.
+    """
+    app = state.app
+    logger = logging.Logger(log_name)
+    # Records still propagate to the root logger, like those of logging.getLogger
+    logger.parent = logging.root
 
     class DebugHandler(logging.StreamHandler):
         def emit(self, record):
             if app.debug and _should_log_for(app, 'debug'):
                 logging.StreamHandler.emit(self, record)
 
-    logger.setLevel(logex.LOG_LEVEL)
+    logger.setLevel(state.LOG_LEVEL)
 
     debug_handler = DebugHandler()
     debug_handler.setLevel(logging.DEBUG)
-    debug_handler.setFormatter(logex.log_format)
+    debug_handler.setFormatter(state.log_format)
 
-    file_handler = logging.FileHandler(log_path)
-    file_handler.setLevel(logex.LOG_LEVEL)
-    file_handler.setFormatter(logex.log_format)
+    # Records of every logger are buffered and rotated by the sink of LOG_PATH
+    state.sink.add(log_name, state.log_format)
 
-    logger.addHandler(file_handler)
+    # File writes are done by the listener thread when queued
+    if state.log_listener is not None:
+        state.log_listener.set_handler(log_name, state.sink)
+        queue_handler = QueueHandler(state.log_listener)
+        queue_handler.setLevel(state.LOG_LEVEL)
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(state.sink)
     logger.addHandler(debug_handler)
     return logger
 
 
-def log_exception(log_name, message, trace_id):
-    """Override."""
-    logger = get_logger(log_name)
+def _resolve(logger):
+    """Logger given by itself or by its logging.getLogger name."""
+    if isinstance(logger, logging.Logger):
+        return logger
+    return get_logger(logger)
+
+
+def log_exception(logger, message, trace_id, code=None, structured=False, user_agents=None):
+    """
+    Log the error of the current request to a logger or the logger of a name.
+
+    Structured events are dicts of the request fields, written as JSON objects by the
+    JSONFormatter, otherwise a text block for the log_format banner. User agents are
+    parsed through the optional UserAgentCache.
+    """
+    logger = _resolve(logger)
     exc_info = sys.exc_info()
-    data = ("""[trace-id]          %s
+    if user_agents is not None:
+        user_agent = request.environ.get('HTTP_USER_AGENT', '')
+        platform, browser, version = user_agents.parse(user_agent)
+    else:
+        user_agent = request.user_agent.string
+        platform = request.user_agent.platform
+        browser = request.user_agent.browser
+        version = request.user_agent.version
+    if structured:
+        data = {
+            'trace_id': trace_id,
+            'message': message,
+            'method': request.method,
+            'url': request.url,
+            'client_ip': request.remote_addr,
+            'user_agent': user_agent,
+            'platform': platform,
+            'browser': browser,
+            'version': version,
+            'code': code,
+            'exception': exc_info[0].__name__ if exc_info[0] else None,
+        }
+    else:
+        data = ("""[trace-id]          %s
     [message]           %s
     [method]            %s
     [url]               %s
@@ -78,16 +335,27 @@ def log_exception(log_name, message, trace_id):
     [browser]:          %s
     [version]:          %s
     """ % (trace_id,
-           message,
-           request.method,
-           request.url,
-           request.remote_addr,
-           request.user_agent.string,
-           request.user_agent.platform,
-           request.user_agent.browser,
-           request.user_agent.version
-           ))
+               message,
+               request.method,
+               request.url,
+               request.remote_addr,
+               user_agent,
+               platform,
+               browser,
+               version
+               ))
     if exc_info[1] is None:
         logger.error(data)
     else:
         logger.error(data, exc_info=exc_info)
+
+
+def log_suppressed(logger, kind, code, exc_type, count, structured=False):
+    """Summary of the errors that were not traced or logged."""
+    logger = _resolve(logger)
+    if structured:
+        logger.warning({'message': 'suppressed', 'suppressed': count, 'kind': kind,
+                        'exception': exc_type.__name__, 'code': code})
+    else:
+        logger.warning("[suppressed]        %d %s of %s (%s)",
+                       count, kind, exc_type.__name__, code)
@@ -0,0 +1,178 @@
+"""
+In-process metrics of the errors, traces and logs handled by LogEx.
+
+Each thread updates its own shard of counters and histograms without locking, shards are
+only summed when the metrics are rendered in the Prometheus text format. The shard of a
+finished thread is folded into the retired totals, so thread per request servers do not
+accumulate shards.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+# Name to help text and label names
+COUNTERS = {
+    'logex_errors_total': ("Errors handled by LogEx.", ('code', 'type', 'endpoint')),
+    'logex_traces_total': ("Errors traced.", ('code',)),
+    'logex_logs_total': ("Errors logged.", ('code',)),
+    'logex_trace_cache_total': ("Trace cache lookups of Tracer.get.", ('result',)),
+    'logex_dropped_total': ("Traces and logs dropped.", ('kind', 'reason')),
+    'logex_user_agent_cache_total': ("User agent parse cache lookups.", ('result',)),
+}
+HISTOGRAMS = {
+    'logex_trace_seconds': ("Time spent tracing an error.", ()),
+    'logex_log_seconds': ("Time spent logging an error.", ()),
+}
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    pairs.extend('%s="%s"' % pair for pair in extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metrics(object):
+    """Registry of counters and histograms aggregated per thread."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        # Weak reference of a live thread to its shard
+        self._shards = {}
+        self._retired = ({}, {})
+        # Reentrant, the garbage collector may retire a shard while the lock is held
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            ref = weakref.ref(threading.current_thread(), self._retire)
+            with self._lock:
+                self._shards[ref] = shard
+            return shard
+
+    def _retire(self, ref):
+        """Fold the shard of a finished thread into the retired totals."""
+        with self._lock:
+            shard = self._shards.pop(ref, None)
+            if shard is not None:
+                self._merge(self._retired, shard)
+
+    @staticmethod
+    def _merge(totals, shard):
+        """Add the counters and histograms of a shard to totals."""
+        counters, histograms = totals
+        for key, value in shard[0].items():
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in shard[1].items():
+            total = histograms.setdefault(key, [0] * len(histogram))
+            for index, value in enumerate(list(histogram)):
+                total[index] += value
+
+    def inc(self, name, *labels, **kwargs):
+        """Increment the counter with the label values by `value`, 1 by default."""
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + kwargs.get('value', 1)
+
+    def observe(self, name, value, *labels):
+        """Record a value, in seconds, in the histogram with the label values."""
+        histograms = self._shard()[1]
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Bucket counts followed by the sum and count
+            histogram = histograms[key] = [0] * (len(self.buckets) + 3)
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def collect(self):
+        """Counters and histograms summed across threads."""
+        totals = ({}, {})
+        with self._lock:
+            self._merge(totals, self._retired)
+            shards = list(self._shards.values())
+        for shard in shards:
+            self._merge(totals, shard)
+        return totals
+
+    def value(self, name, *labels):
+        """Current value of a counter."""
+        return self.collect()[0].get((name, labels), 0)
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+        lines = []
+        for name in sorted(COUNTERS):
+            help_text, label_names = COUNTERS[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s counter' % name)
+            for (key, labels), value in sorted(counters.items()):
+                if key == name:
+                    lines.append('%s%s %s' % (name, _labels(label_names, labels), value))
+        for name in sorted(HISTOGRAMS):
+            help_text, label_names = HISTOGRAMS[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s histogram' % name)
+            for (key, labels), histogram in sorted(histograms.items()):
+                if key != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (
+                        name, _labels(label_names, labels, [('le', bound)]), cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(label_names, labels), histogram[-2]))
+                lines.append('%s_count%s %s' % (name, _labels(label_names, labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class Timings(object):
+    """
+    Listeners called with the name and duration of LogEx stages.
+
+    Stages are `handle_http_exception`, `handler`, `stack_trace`, `trace_hash`, `cache` and
+    `log_exception`. Without listeners no clock is read.
+    """
+
+    def __init__(self):
+        self.listeners = []
+
+    def connect(self, listener):
+        """Call `listener(stage, seconds)` after every stage."""
+        self.listeners.append(listener)
+        return listener
+
+    def disconnect(self, listener):
+        self.listeners.remove(listener)
+
+    def clock(self):
+        """Start time of a stage, None when nobody listens."""
+        if self.listeners:
+            return time.time()
+
+    def emit(self, stage, start):
+        """Report a stage started at `start` to the listeners."""
+        if start is None or not self.listeners:
+            return
+        duration = time.time() - start
+        for listener in self.listeners:
+            listener(stage, duration)
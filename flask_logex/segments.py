@@ -0,0 +1,272 @@
+"""
+Append-only segmented trace store.
+
+Traces are appended to size rotated segment files and located through an in-memory index of
+key to segment, offset and length. Segments are read through mmap and expire as a whole once
+older than the maximum age, so writes and lookups stay constant time however many traces are
+stored.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+import fcntl
+import mmap
+from contextlib import contextmanager
+import os
+import pickle
+import struct
+import threading
+import time
+from werkzeug.contrib.cache import BaseCache
+
+# Key length and value length, a value length of 0 marks a deleted key
+_header = struct.Struct('>HI')
+# Appends to the directory, kept at the start of its lock file
+_generation = struct.Struct('>Q')
+_suffix = '.seg'
+
+
+class SegmentCache(BaseCache):
+    """
+    Werkzeug cache over append-only segment files.
+
+    Writes hold an flock on the lock file of the directory so processes sharing it append to
+    the same segments, and bump the generation counter of the lock file. Reads only index
+    the records other processes appended when the generation changed since the last lookup.
+    Read-modify-writes like inc run under the flock, so they are atomic across
+    processes. Per-key timeouts are ignored, segments expire by age.
+    """
+
+    def __init__(self, cache_dir, segment_bytes=64 * 1024 * 1024, max_age=86400,
+                 default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.cache_dir = cache_dir
+        self.segment_bytes = segment_bytes
+        self.max_age = max_age
+        self._index = {}
+        self._maps = {}
+        self._scanned = {}
+        self._active = None
+        self._fd = None
+        self._pid = None
+        self._lock_fd = None
+        self._lock_map = None
+        self._lock_pid = None
+        self._seen = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with self._lock:
+            self._refresh()
+
+    @contextmanager
+    def _locked(self):
+        """Hold the thread lock and the flock of the directory shared by all processes."""
+        with self._lock:
+            fd = self._lock_file()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _lock_file(self):
+        """Descriptor of the lock file of the directory."""
+        # Forked processes share the parent's open lock file, each needs its own
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(os.path.join(self.cache_dir, 'lock'),
+                                    os.O_RDWR | os.O_CREAT)
+            self._lock_map = None
+            self._lock_pid = os.getpid()
+        return self._lock_fd
+
+    def _generation(self, bump=False):
+        """Generation of the directory, bumped holding the flock, None before any append."""
+        fd = self._lock_file()
+        if self._lock_map is None:
+            if os.fstat(fd).st_size < _generation.size:
+                if not bump:
+                    return None
+                os.ftruncate(fd, _generation.size)
+            self._lock_map = mmap.mmap(fd, _generation.size)
+        generation = _generation.unpack_from(self._lock_map)[0]
+        if bump:
+            generation += 1
+            _generation.pack_into(self._lock_map, 0, generation)
+        return generation
+
+    def _refresh(self):
+        """Index the records appended by other processes when the generation changed."""
+        generation = self._generation()
+        if generation is None or generation != self._seen:
+            self._catch_up()
+            self._seen = generation
+
+    def _path(self, segment):
+        return os.path.join(self.cache_dir, '%012d%s' % (segment, _suffix))
+
+    def _segments(self):
+        return sorted(int(name[:-len(_suffix)]) for name in os.listdir(self.cache_dir)
+                      if name.endswith(_suffix))
+
+    def _map(self, segment, end):
+        """Read-only map of a segment covering at least `end` bytes."""
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            with open(self._path(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            old = self._maps.get(segment)
+            if old is not None:
+                old.close()
+            self._maps[segment] = mapped
+        return mapped
+
+    def _catch_up(self):
+        """Index the records appended since the last scan."""
+        for segment in self._segments():
+            offset = self._scanned.get(segment, 0)
+            try:
+                size = os.path.getsize(self._path(segment))
+            except OSError:
+                continue
+            if size <= offset:
+                continue
+            mapped = self._map(segment, size)
+            while offset + _header.size <= size:
+                key_length, value_length = _header.unpack_from(mapped, offset)
+                end = offset + _header.size + key_length + value_length
+                if end > size:
+                    break
+                key = mapped[offset + _header.size:offset + _header.size + key_length]
+                if value_length:
+                    self._index[key] = (segment, end - value_length, value_length)
+                else:
+                    self._index.pop(key, None)
+                offset = end
+            self._scanned[segment] = offset
+
+    def _open(self):
+        """Descriptor of the active segment, rotated once it exceeds segment_bytes."""
+        if self._fd is not None and self._pid == os.getpid():
+            if os.fstat(self._fd).st_size < self.segment_bytes:
+                return self._fd
+            os.close(self._fd)
+            self._fd = None
+            self._active += 1
+        if self._active is None or self._pid != os.getpid():
+            segments = self._segments()
+            self._active = segments[-1] if segments else 0
+        self._fd = os.open(self._path(self._active), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self._pid = os.getpid()
+        if os.fstat(self._fd).st_size >= self.segment_bytes:
+            return self._open()
+        self._expire()
+        return self._fd
+
+    def _expire(self):
+        """Remove segments older than max_age and their index entries."""
+        if not self.max_age:
+            return
+        cutoff = time.time() - self.max_age
+        expired = set()
+        for segment in self._segments():
+            if segment == self._active:
+                continue
+            try:
+                if os.path.getmtime(self._path(segment)) >= cutoff:
+                    continue
+                os.remove(self._path(segment))
+            except OSError:
+                pass
+            expired.add(segment)
+            mapped = self._maps.pop(segment, None)
+            if mapped is not None:
+                mapped.close()
+            self._scanned.pop(segment, None)
+        if expired:
+            for key, location in self._index.items():
+                if location[0] in expired:
+                    del self._index[key]
+
+    def _append(self, key, data):
+        """Append a record, called holding the locks of _locked."""
+        record = _header.pack(len(key), len(data)) + key + data
+        fd = self._open()
+        offset = os.fstat(fd).st_size
+        os.write(fd, record)
+        if self._scanned.get(self._active, 0) == offset:
+            self._scanned[self._active] = offset + len(record)
+        if data:
+            self._index[key] = (self._active, offset + len(record) - len(data), len(data))
+        else:
+            self._index.pop(key, None)
+        # Indexed up to date by _locked, only other processes need to catch up
+        self._seen = self._generation(bump=True)
+
+    def _get(self, key):
+        location = self._index.get(key)
+        if location is None:
+            return None
+        segment, offset, length = location
+        try:
+            mapped = self._map(segment, offset + length)
+            return pickle.loads(mapped[offset:offset + length])
+        except (EnvironmentError, ValueError, pickle.UnpicklingError):
+            self._index.pop(key, None)
+            return None
+
+    def get(self, key):
+        with self._lock:
+            # Values of keys already indexed may have been rewritten by other processes
+            self._refresh()
+            return self._get(str(key))
+
+    def set(self, key, value, timeout=None):
+        with self._locked():
+            self._append(str(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return True
+
+    def add(self, key, value, timeout=None):
+        key = str(key)
+        with self._locked():
+            if self._get(key) is not None:
+                return False
+            self._append(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return True
+
+    def inc(self, key, delta=1):
+        key = str(key)
+        with self._locked():
+            value = (self._get(key) or 0) + delta
+            self._append(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def delete(self, key):
+        key = str(key)
+        with self._locked():
+            if self._get(key) is None:
+                return False
+            self._append(key, '')
+        return True
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._locked():
+            for mapped in self._maps.values():
+                mapped.close()
+            if self._fd is not None:
+                os.close(self._fd)
+            for segment in self._segments():
+                os.remove(self._path(segment))
+            self._index.clear()
+            self._maps.clear()
+            self._scanned.clear()
+            self._active = self._fd = self._pid = None
+        return True
@@ -0,0 +1,203 @@
+"""
+Shared log sink of LogEx.
+
+One handler per log directory buffers the records of every logger writing there, from all
+applications of the process, and appends them to the log file of each logger name. Buffers
+are flushed when full and periodically from a background thread. Files are only opened
+while flushing, rotation is coordinated between pre-fork workers with an exclusive lock on
+the file being written where fcntl is available.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+import errno
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock, rotation is not coordinated between processes
+    fcntl = None
+
+_flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+_fork_lock = threading.Lock()
+_formatter = logging.Formatter()
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_sink(directory, **options):
+    """Sink of a log directory, created with the options of its first caller."""
+    key = os.path.abspath(directory)
+    with _sinks_lock:
+        if key not in _sinks:
+            _sinks[key] = LogSink(directory, **options)
+        return _sinks[key]
+
+
+class LogSink(logging.Handler):
+    """
+    Buffered handler writing records to `<directory>/<logger name>.log`.
+
+    Files are rotated to `.1` ... `.<backups>` once a flush would grow them past max_bytes,
+    or when their last write was in a previous interval of seconds, at midnight UTC for the
+    default of a day. A max_bytes or interval of 0 disables that rotation.
+    """
+
+    def __init__(self,
+                 directory,
+                 max_bytes=64 * 1024 * 1024,
+                 interval=86400,
+                 backups=7,
+                 buffer_bytes=64 * 1024,
+                 flush_interval=1.0):
+        logging.Handler.__init__(self)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backups = backups
+        self.buffer_bytes = buffer_bytes
+        self.flush_interval = flush_interval
+        self.rotations = 0
+        self.formatters = {}
+        self._buffer = {}
+        self._size = 0
+        self._pid = None
+        self._closed = False
+
+    def path(self, log_name):
+        """Log file of a logger name."""
+        return os.path.join(self.directory, log_name + ".log")
+
+    def add(self, log_name, formatter=None):
+        """Create the log file of a logger name, its records are formatted by formatter."""
+        if formatter is not None:
+            self.formatters[log_name] = formatter
+        os.close(os.open(self.path(log_name), _flags, 0644))
+
+    def _start(self):
+        """Start the flush thread, restarted in forked processes, called under _fork_lock."""
+        pid = os.getpid()
+        if self._pid is not None:
+            # Records buffered by the parent are written by the parent, its lock may have
+            # been held by one of its threads while forking
+            self.createLock()
+            self._buffer = {}
+            self._size = 0
+        self._pid = pid
+        if self.flush_interval:
+            thread = threading.Thread(target=self._run, args=(pid,), name="logex-log-sink")
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, pid):
+        while not self._closed and self._pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def acquire(self):
+        # Every use of the sink, logging, flushing or closing at exit, goes through its lock,
+        # a forked process first drops the copy of its parent's buffer and lock
+        if self._pid != os.getpid():
+            with _fork_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        logging.Handler.acquire(self)
+
+    def emit(self, record):
+        try:
+            formatter = self.formatters.get(record.name) or self.formatter or _formatter
+            line = formatter.format(record) + "\n"
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+        except Exception:
+            self.handleError(record)
+            return
+        self._buffer.setdefault(record.name, []).append(line)
+        self._size += len(line)
+        if self._size >= self.buffer_bytes:
+            self._write()
+
+    def flush(self):
+        """Write the buffered records."""
+        self.acquire()
+        try:
+            self._write()
+        finally:
+            self.release()
+
+    def _write(self):
+        buffer, self._buffer, self._size = self._buffer, {}, 0
+        for log_name, lines in buffer.iteritems():
+            try:
+                self._append(self.path(log_name), "".join(lines))
+            except EnvironmentError as e:
+                sys.stderr.write("LogEx dropped %d records of %s: %s\n" % (
+                    len(lines), log_name, e))
+
+    def _append(self, path, data):
+        """Append data to a log file, rotating it first when due."""
+        while True:
+            try:
+                fd = os.open(path, _flags, 0644)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Log directory removed since the sink was created
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    if not os.path.isdir(self.directory):
+                        raise
+                fd = os.open(path, _flags, 0644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                stat = os.fstat(fd)
+                try:
+                    current = os.stat(path).st_ino
+                except OSError:
+                    current = None
+                if current != stat.st_ino:
+                    # Rotated by another process between opening and locking
+                    continue
+                if self._due(stat, len(data)):
+                    self._rotate(path)
+                    continue
+                os.write(fd, data)
+                return
+            finally:
+                os.close(fd)
+
+    def _due(self, stat, size):
+        """Whether a file is rotated before appending size bytes."""
+        if not stat.st_size:
+            return False
+        if self.max_bytes and stat.st_size + size > self.max_bytes:
+            return True
+        if self.interval:
+            return int(stat.st_mtime // self.interval) != int(time.time() // self.interval)
+        return False
+
+    def _rotate(self, path):
+        """Shift the backups of a log file, called holding the lock of the file."""
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                source = "%s.%d" % (path, i)
+                if os.path.exists(source):
+                    os.rename(source, "%s.%d" % (path, i + 1))
+            os.rename(path, path + ".1")
+        else:
+            os.unlink(path)
+        self.rotations += 1
+
+    def close(self):
+        """Write the buffered records and stop the flush thread."""
+        self.flush()
+        self._closed = True
+        logging.Handler.close(self)
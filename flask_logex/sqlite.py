@@ -0,0 +1,215 @@
+"""
+SQLite trace store.
+
+Traces are kept in a single table of a SQLite database in WAL mode, surviving restarts, with
+the timestamp, code, endpoint, exception type and fingerprint of each trace in indexed
+columns so they can be searched with Tracer.query.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+from time import time
+from werkzeug.contrib.cache import BaseCache
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS traces (
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        expires REAL NOT NULL,
+        timestamp REAL,
+        code INTEGER,
+        endpoint TEXT,
+        exception TEXT,
+        fingerprint TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS traces_timestamp ON traces (timestamp)",
+    "CREATE INDEX IF NOT EXISTS traces_code ON traces (code, timestamp)",
+    "CREATE INDEX IF NOT EXISTS traces_endpoint ON traces (endpoint, timestamp)",
+    "CREATE INDEX IF NOT EXISTS traces_exception ON traces (exception, timestamp)",
+    "CREATE INDEX IF NOT EXISTS traces_fingerprint ON traces (fingerprint)",
+)
+COLUMNS = ('timestamp', 'code', 'endpoint', 'exception', 'fingerprint')
+
+# Statements are prepared once per connection by the sqlite3 statement cache
+INSERT = ("INSERT OR REPLACE INTO traces (key, value, expires, %s) VALUES (?, ?, ?, %s)" %
+          (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))))
+INSERT_NEW = INSERT.replace('OR REPLACE', 'OR IGNORE')
+EXPIRED = "DELETE FROM traces WHERE expires != 0 AND expires <= ?"
+LIVE = "(expires = 0 OR expires > ?)"
+EXPIRED_KEY = "DELETE FROM traces WHERE key = ? AND NOT %s" % LIVE
+
+
+def _dumps(value):
+    # Counters stay integers so they are incremented in SQL
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _loads(value):
+    if isinstance(value, (int, long)):
+        return value
+    return pickle.loads(str(value))
+
+
+class SQLiteCache(BaseCache):
+    """
+    Werkzeug cache over a SQLite table with searchable trace columns.
+
+    Each thread uses its own connection, reopened after a fork. Writes of a batch run in a
+    single transaction and expired rows are deleted every `prune_interval` writes.
+    """
+
+    def __init__(self, path, default_timeout=300, prune_interval=1000, busy_timeout=5.0):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.prune_interval = prune_interval
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._connection() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time() + timeout if timeout > 0 else 0
+
+    def _write(self, statement, rows, expired=False):
+        """
+        Run a statement for the rows in one transaction, returns the changed row count.
+
+        With expired, expired rows of the keys are first deleted in the same transaction.
+        """
+        connection = self._connection()
+        with connection:
+            if expired:
+                now = time()
+                connection.executemany(EXPIRED_KEY, [(row[0], now) for row in rows])
+            changes = connection.total_changes
+            connection.executemany(statement, rows)
+            self._writes += len(rows)
+            if self._writes >= self.prune_interval:
+                self._writes = 0
+                connection.execute(EXPIRED, (time(),))
+            return connection.total_changes - changes
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        keys = [str(key) for key in keys]
+        values = {}
+        if keys:
+            cursor = self._connection().execute(
+                "SELECT key, value FROM traces WHERE key IN (%s) AND %s" % (
+                    ', '.join('?' * len(keys)), LIVE),
+                keys + [time()])
+            values = dict((key, _loads(value)) for key, value in cursor)
+        return [values.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        return self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        expires = self._expires(timeout)
+        self._write(INSERT, [(str(key), _dumps(value), expires) + (None,) * len(COLUMNS)
+                             for key, value in mapping.items()])
+        return True
+
+    def set_traces(self, rows, timeout=None, add=False):
+        """
+        Store `(key, value, columns)` rows in one transaction.
+
+        Columns is a dict of the COLUMNS values of the trace, with add the rows of live keys
+        are left untouched.
+        """
+        expires = self._expires(timeout)
+        self._write(INSERT_NEW if add else INSERT, [
+            (str(key), _dumps(value), expires) + tuple(columns.get(name) for name in COLUMNS)
+            for key, value, columns in rows], expired=add)
+        return True
+
+    def add(self, key, value, timeout=None):
+        expires = self._expires(timeout)
+        return self._write(INSERT_NEW, [(str(key), _dumps(value), expires) +
+                                        (None,) * len(COLUMNS)], expired=True) > 0
+
+    def delete(self, key):
+        return self.delete_many(key)
+
+    def delete_many(self, *keys):
+        self._write("DELETE FROM traces WHERE key = ?", [(str(key),) for key in keys])
+        return True
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def inc(self, key, delta=1):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "UPDATE traces SET value = value + ? WHERE key = ? AND typeof(value) = 'integer'"
+                " AND %s" % LIVE, (delta, str(key), time()))
+            row = connection.execute(
+                "SELECT value FROM traces WHERE key = ? AND %s" % LIVE,
+                (str(key), time())).fetchone()
+            if row is not None and isinstance(row[0], (int, long)):
+                return row[0]
+        self.set(key, delta)
+        return delta
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM traces")
+        return True
+
+    def query(self, start=None, end=None, code=None, endpoint=None, exception=None,
+              fingerprint=None, limit=100, offset=0):
+        """
+        Key, timestamp and fingerprint of the traces matching the filters, newest first.
+
+        Traces are matched on timestamp `start <= timestamp < end` and the exact code,
+        endpoint, exception type and fingerprint given, pages are selected with limit and
+        offset.
+        """
+        clauses = [LIVE, "timestamp IS NOT NULL"]
+        params = [time()]
+        if start is not None:
+            clauses.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("timestamp < ?")
+            params.append(end)
+        for name, value in (('code', code), ('endpoint', endpoint),
+                            ('exception', exception), ('fingerprint', fingerprint)):
+            if value is not None:
+                clauses.append("%s = ?" % name)
+                params.append(value)
+        params.extend((limit, offset))
+        return self._connection().execute(
+            "SELECT key, timestamp, fingerprint FROM traces WHERE %s"
+            " ORDER BY timestamp DESC LIMIT ? OFFSET ?" % ' AND '.join(clauses),
+            params).fetchall()
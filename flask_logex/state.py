@@ -0,0 +1,127 @@
+"""
+Per application state of LogEx.
+
+Every application initialized by a LogEx instance gets its own state in
+`app.extensions['logex']`, holding the cache client, tracer, loggers, frozen config and
+metrics of that application. Requests resolve it from the current application.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+import os
+import threading
+
+from logger import UserAgentCache
+from logger import add_logger
+from metrics import Metrics
+from trace import Tracer
+from trace import serializers
+from writer import TraceWriter
+
+
+class LogExState(object):
+    """Resources of LogEx built for one application and reused by all of its requests."""
+
+    def __init__(self, logex, app, api=None):
+        self.logex = logex
+        self.app = app
+        self.api = api
+        # Log
+        self.log_format = logex.log_format
+        self.log_listener = None
+        self.logs = {}
+        self.sink = None
+        # Frozen settings read by requests, built by LogEx.freeze
+        self.config = None
+        # Trace
+        self.cache_config = None
+        self.cache_args = None
+        self.cache_options = None
+        self.cache_obj = None
+        self._cache = None
+        self._cache_pid = None
+        self._cache_lock = threading.Lock()
+        self._tracer = None
+        # Metrics and parsed user agents
+        self.metrics = Metrics()
+        self.user_agents = UserAgentCache(metrics=self.metrics)
+
+    def logger(self, log_name):
+        """Logger of the application for a log name, added on first use."""
+        logger = self.logs.get(log_name)
+        if logger is None:
+            logger = self.logs[log_name] = add_logger(log_name, self)
+        return logger
+
+    @property
+    def cache(self):
+        """
+        Trace cache shared by every request of the application in this process.
+
+        The cache client is created once per process and rebuilt when the pid
+        changes, so pre-fork workers never share a parent's connections.
+        """
+        pid = os.getpid()
+        if self._cache is None or self._cache_pid != pid:
+            with self._cache_lock:
+                if self._cache is None or self._cache_pid != pid:
+                    self.reset_cache()
+                    config = self.cache_config
+                    self._cache = self.cache_obj(
+                        self.app,
+                        config,
+                        self.cache_args[:],
+                        dict(self.cache_options))
+                    self._tracer = Tracer(
+                        self._cache,
+                        serializer=self.make_serializer(),
+                        metrics=self.metrics,
+                        timings=self.logex.timings,
+                        fingerprint=config['LOGEX_TRACE_FINGERPRINT'],
+                        occurrences=config['LOGEX_TRACE_OCCURRENCES'],
+                        limits=dict(
+                            stack_trace=config['LOGEX_TRACE_MAX_STACK_TRACE'],
+                            request_headers=config['LOGEX_TRACE_MAX_HEADERS'],
+                            request_body=config['LOGEX_TRACE_MAX_REQUEST_BODY'],
+                            response_body=config['LOGEX_TRACE_MAX_RESPONSE_BODY']))
+                    if config['LOGEX_TRACE_ASYNC']:
+                        writer = TraceWriter(
+                            self._tracer,
+                            maxsize=config['LOGEX_TRACE_QUEUE_SIZE'],
+                            policy=config['LOGEX_TRACE_QUEUE_POLICY'],
+                            timeout=config['LOGEX_TRACE_QUEUE_TIMEOUT'],
+                            batch_size=config['LOGEX_TRACE_BATCH_SIZE'])
+                        self._tracer.writer = writer
+                    self._cache_pid = pid
+        return self._cache
+
+    def reset_cache(self):
+        """Drop the cache client and tracer, stopping the trace writer of this process."""
+        tracer, self._tracer = self._tracer, None
+        if tracer is not None and tracer.writer is not None:
+            tracer.writer.close()
+        self._cache = None
+        self._cache_pid = None
+
+    def make_serializer(self):
+        """Trace serializer selected by LOGEX_TRACE_FORMAT."""
+        serializer = serializers[self.cache_config['LOGEX_TRACE_FORMAT']]
+        if self.cache_config['LOGEX_TRACE_COMPRESS']:
+            return serializer(compress=True)
+        return serializer()
+
+    @property
+    def tracer(self):
+        """Tracer reusing the process wide cache client."""
+        self.cache  # Builds the cache and tracer for this process
+        return self._tracer
+
+    def flush(self, timeout=None):
+        """Wait for queued traces and log records to be written."""
+        if self._tracer is not None and self._tracer.writer is not None:
+            self._tracer.writer.flush(timeout)
+        if self.log_listener is not None:
+            self.log_listener.flush(timeout)
+        if self.sink is not None:
+            self.sink.flush()
@@ -0,0 +1,126 @@
+"""
+Sampling and rate limiting of traces and logs.
+
+Rates and limits are keyed by error code or exception class, exception classes are matched
+against the MRO of the raised exception before falling back on the error code.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket refilled at `rate` tokens per second up to `burst` tokens."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self):
+        """Take a token, returns False when the bucket is empty."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Throttle(object):
+    """Decides which errors are traced or logged and counts the suppressed ones."""
+
+    def __init__(self, sample_rates=None, rate_limits=None, summary_interval=60):
+        """
+        Create a throttle.
+
+        Parameters
+        ----------
+        sample_rates : dict
+            Error code or exception class to the fraction of events kept, 0 to 1.
+        rate_limits : dict
+            Error code or exception class to a `(rate, burst)` tuple, events per second kept
+            and the burst allowed above that rate.
+        summary_interval : int
+            Seconds between summaries of suppressed events, see pending for events that stop.
+        """
+        self.sample_rates = sample_rates or {}
+        self.buckets = {}
+        for key, limit in (rate_limits or {}).items():
+            self.buckets[key] = TokenBucket(*limit)
+        self.summary_interval = summary_interval
+        self.suppressed = {}
+        self.summarized = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def lookup(table, code, exc_type):
+        """Key of the table matching the exception class or error code."""
+        for cls in exc_type.__mro__:
+            if cls in table:
+                return cls
+        if code in table:
+            return code
+        return None
+
+    def check(self, code, exc_type):
+        """
+        Check whether an error is kept.
+
+        Returns
+        -------
+        tuple
+            Whether the event is kept and the number of suppressed events of the same code and
+            exception type to summarize, 0 when no summary is due.
+        """
+        if not self.sample_rates and not self.buckets:
+            return True, 0
+        allowed = True
+        key = self.lookup(self.sample_rates, code, exc_type)
+        if key is not None:
+            allowed = random.random() < self.sample_rates[key]
+        key = self.lookup(self.buckets, code, exc_type)
+        if allowed and key is not None:
+            allowed = self.buckets[key].consume()
+
+        event = (code, exc_type)
+        now = time.time()
+        with self._lock:
+            if not allowed:
+                self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                summarized = self.summarized.setdefault(event, now)
+                if now - summarized < self.summary_interval:
+                    return False, 0
+            count = self.suppressed.pop(event, 0)
+            self.summarized[event] = now
+            return allowed, count
+
+    def pending(self, force=False):
+        """
+        Suppressed events no later event of their own reported.
+
+        Returns
+        -------
+        list
+            `(code, exc_type, count)` of every event suppressed for `summary_interval` seconds
+            without a summary, or of every suppressed event with force.
+        """
+        if not self.suppressed:
+            return []
+        now = time.time()
+        due = []
+        with self._lock:
+            for event, count in self.suppressed.items():
+                if force or now - self.summarized.get(event, now) >= self.summary_interval:
+                    due.append(event + (count,))
+                    del self.suppressed[event]
+                    self.summarized[event] = now
+        return due
@@ -11,25 +11,99 @@ for creating the snapshot as well as a hash to uniquely represent the request it
 import time
 import json
 import hashlib
+import struct
+import sys
 import traceback
+import zlib
 from base64 import b64encode, b64decode
 from datetime import datetime
 
+from metrics import Timings
+
+
+_missing = object()
+
+# Default byte limits of the captured trace fields
+LIMITS = {
+    'stack_trace': 64 * 1024,
+    'request_headers': 16 * 1024,
+    'request_body': 64 * 1024,
+    'response_body': 64 * 1024,
+}
+
+
+def truncate(value, limit, tail=False):
+    """Value cut to `limit` bytes with a marker of the bytes left out, the end with tail."""
+    if not limit or len(value) <= limit:
+        return value
+    marker = '...[truncated %d bytes]' % (len(value) - limit)
+    if tail:
+        return marker + value[-limit:]
+    return value[:limit] + marker
+
+
+def _textual(mimetype):
+    return mimetype == 'application/json' or mimetype.endswith('+json') or \
+        mimetype.startswith('text/')
+
+
+def _field(index):
+    """Property decoding the field at index on first access."""
+    def getter(self):
+        value = self._values[index]
+        if value is _missing:
+            value = self._values[index] = self._decode(index, self._raw[index])
+        return value
+
+    def setter(self, value):
+        self._values[index] = value
+    return property(getter, setter)
+
 
 class Trace(object):
-    """Encapsulates the data for a request trace."""
+    """
+    Encapsulates the data for a request trace.
+
+    Traces read from the cache are lazy, each field is decoded from the stored data on first
+    access and kept.
+    """
+
+    __slots__ = ('_raw', '_decode', '_values', 'fingerprint', 'occurrences', 'timestamps')
+
+    timestamp = _field(0)
+    stack_trace = _field(1)
+    request_headers = _field(2)
+    request_body = _field(3)
+    response_body = _field(4)
 
     def __init__(self,
                  timestamp,
                  stack_trace,
                  request_headers,
                  request_body,
-                 response_body):
-        self.timestamp = timestamp
-        self.stack_trace = stack_trace
-        self.request_headers = request_headers
-        self.request_body = request_body
-        self.response_body = response_body
+                 response_body,
+                 fingerprint=None,
+                 occurrences=None,
+                 timestamps=None):
+        self._raw = None
+        self._decode = None
+        self._values = [timestamp, stack_trace, request_headers, request_body, response_body]
+        # Grouped traces only, number and recent timestamps of occurrences
+        self.fingerprint = fingerprint
+        self.occurrences = occurrences
+        self.timestamps = timestamps
+
+    @classmethod
+    def lazy(cls, raw, decode):
+        """Trace over the raw stored fields, decoded with `decode(index, raw_field)`."""
+        trace = cls.__new__(cls)
+        trace._raw = raw
+        trace._decode = decode
+        trace._values = [_missing] * 5
+        trace.fingerprint = None
+        trace.occurrences = None
+        trace.timestamps = None
+        return trace
 
     def __str__(self):
         formatted_time = datetime.fromtimestamp(self.timestamp).strftime('%Y-%m-%d %H:%M:%S')
@@ -49,50 +123,386 @@ class Trace(object):
         return string
 
 
+class LegacySerializer(object):
+    """Original format, each field base64 encoded and joined by dots."""
+
+    def match(self, data):
+        return True
+
+    def dumps(self, snapshot):
+        timestamp, stack_trace, request_headers, request_body, response_body = snapshot
+        return '.'.join((b64encode(repr(timestamp)),
+                         b64encode(stack_trace),
+                         b64encode(request_headers),
+                         b64encode(request_body),
+                         b64encode(json.dumps(response_body, separators=(',', ':')))))
+
+    def split(self, data):
+        return data.split('.')
+
+    def decode(self, index, raw):
+        value = b64decode(raw)
+        if index == 0:
+            return float(value)
+        if index in (3, 4):
+            return json.loads(value)
+        return value
+
+    def loads(self, data):
+        return tuple(self.decode(index, raw) for index, raw in enumerate(self.split(data)))
+
+
+class BinarySerializer(object):
+    """
+    Compact length-prefixed binary format.
+
+    A header of magic bytes, version and flags is followed by the timestamp as a double and
+    the four remaining fields, each prefixed with its unsigned 32 bit length. The payload
+    after the header is zlib compressed when the compressed flag is set.
+    """
+
+    MAGIC = '\x93LX'
+    VERSION = 1
+    COMPRESSED = 0x01
+
+    _header = struct.Struct('>3sBB')
+    _timestamp = struct.Struct('>d')
+    _length = struct.Struct('>I')
+
+    def __init__(self, compress=False, level=6):
+        self.compress = compress
+        self.level = level
+
+    def match(self, data):
+        return data[:3] == self.MAGIC
+
+    def dumps(self, snapshot):
+        timestamp, stack_trace, request_headers, request_body, response_body = snapshot
+        parts = [self._timestamp.pack(timestamp)]
+        for field in (stack_trace, request_headers, request_body, response_body):
+            parts.append(self._length.pack(len(field)))
+            parts.append(field)
+        payload = ''.join(parts)
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload, self.level)
+            flags |= self.COMPRESSED
+        return self._header.pack(self.MAGIC, self.VERSION, flags) + payload
+
+    def split(self, data):
+        """Timestamp and buffers over the raw fields of a serialized trace."""
+        magic, version, flags = self._header.unpack_from(data)
+        if version != self.VERSION:
+            raise ValueError("Unsupported trace format version %d" % version)
+        payload = buffer(data, self._header.size)
+        if flags & self.COMPRESSED:
+            payload = zlib.decompress(payload)
+        timestamp, = self._timestamp.unpack_from(payload)
+        offset = self._timestamp.size
+        fields = [timestamp]
+        for _ in range(4):
+            length, = self._length.unpack_from(payload, offset)
+            offset += self._length.size
+            fields.append(buffer(payload, offset, length))
+            offset += length
+        return fields
+
+    def decode(self, index, raw):
+        if index == 0:
+            return raw
+        if index == 3:
+            return json.loads(str(raw))
+        return str(raw)
+
+    def loads(self, data):
+        return tuple(self.decode(index, raw) for index, raw in enumerate(self.split(data)))
+
+
+def fingerprint(request, code):
+    """
+    Hash of the normalized stack trace of the exception being handled.
+
+    Occurrences of the same failure share a fingerprint, built from the exception type and
+    the file, function and line of each frame. Without an exception the endpoint and status
+    code are used.
+    """
+    exc_type, _, tb = sys.exc_info()
+    if exc_type is None:
+        parts = [str(request.endpoint or request.path), str(code)]
+    else:
+        parts = ['%s.%s' % (exc_type.__module__, exc_type.__name__)]
+        for filename, lineno, name, _ in traceback.extract_tb(tb):
+            parts.append('%s:%s:%d' % (filename, name, lineno))
+    return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+
+serializers = {
+    'legacy': LegacySerializer,
+    'binary': BinarySerializer,
+}
+
+
 class Tracer(object):
     """Serializes and deserializes traces, creates a unique hash and calls the cache methods."""
 
-    def __init__(self, cache):
-        """Create a new tracer with the specified werkzeug cache instance as a datastore."""
+    def __init__(self,
+                 cache,
+                 writer=None,
+                 serializer=None,
+                 fingerprint=False,
+                 occurrences=100,
+                 metrics=None,
+                 timings=None,
+                 limits=None):
+        """
+        Create a new tracer with the specified werkzeug cache instance as a datastore.
+
+        Captured fields are cut to the byte limits of LIMITS, updated with `limits`, a limit
+        of 0 or None keeps the whole field. Only JSON request bodies and JSON or text
+        response bodies are captured, streamed responses are never read.
+
+        Traces are written with the serializer, legacy by default, and read back in either
+        format. With fingerprint set, occurrences of the same failure are grouped under one
+        exemplar trace keeping a count and the last `occurrences` timestamps. Cache lookups
+        are counted in the optional flask_logex.metrics.Metrics, stages are reported to the
+        optional flask_logex.metrics.Timings. Caches with a `set_traces` method, like
+        flask_logex.sqlite.SQLiteCache, also store the searchable columns of each trace.
+        """
         self.cache = cache
+        self.writer = writer
+        self.serializer = serializer or LegacySerializer()
+        self.readers = [BinarySerializer(), LegacySerializer()]
+        self.fingerprint = fingerprint
+        self.occurrences = occurrences
+        self.metrics = metrics
+        self.timings = timings or Timings()
+        self.limits = dict(LIMITS, **(limits or {}))
+        self.columns = hasattr(cache, 'set_traces')
+
+    def snapshot(self, request):
+        """
+        Capture the trace fields of the request being handled, without the response body.
+
+        Must run on the request thread, the stack trace is read from the exception
+        currently being handled.
+        """
+        start = self.timings.clock()
+        stack_trace = truncate(traceback.format_exc(), self.limits['stack_trace'], tail=True)
+        self.timings.emit('stack_trace', start)
+        return [time.time(),
+                stack_trace,
+                truncate(str(request.headers), self.limits['request_headers']),
+                self.request_body(request)]
+
+    def request_body(self, request):
+        """
+        Compact JSON of the request body, bodies over the limit are not read.
+
+        Skipped and truncated bodies are stored as a JSON string of the marker or the cut
+        JSON text.
+        """
+        limit = self.limits['request_body']
+        if limit and request.is_json and (request.content_length or 0) > limit:
+            return json.dumps('[skipped %d bytes]' % request.content_length)
+        body = str(json.dumps(request.get_json(silent=True), separators=(',', ':')))
+        if limit and len(body) > limit:
+            return json.dumps(truncate(body, limit))
+        return body
+
+    def response_body(self, response):
+        """JSON or text response body, streamed and binary responses are not captured."""
+        if response.direct_passthrough or response.is_streamed:
+            return '[streamed response]'
+        if not _textual(response.mimetype or ''):
+            return '[skipped %s body]' % response.mimetype
+        return truncate(str(response.get_data()), self.limits['response_body'])
+
+    def dumps(self, snapshot):
+        """Serialize a snapshot with the tracer serializer."""
+        return self.serializer.dumps(snapshot)
+
+    def reader(self, data):
+        """Serializer of the format the data was written in."""
+        for reader in self.readers:
+            if reader.match(data):
+                return reader
+
+    def loads(self, data):
+        """Lazy trace over data written in either format."""
+        reader = self.reader(data)
+        return Trace.lazy(reader.split(data), reader.decode)
+
+    def capture(self, request, code, exc_type=None):
+        """
+        Trace id, snapshot and columns of the request being handled.
+
+        The trace id is a hash of the captured request data, grouped trace ids are the
+        fingerprint followed by the occurrence time. The response body is appended to the
+        snapshot before it is stored. Columns are only captured when the cache stores them,
+        the exception column is exc_type, the exception being handled by default.
+        """
+        snapshot = self.snapshot(request)
+        start = self.timings.clock()
+        fp = fingerprint(request, code) if self.fingerprint else None
+        if fp:
+            trace_id = '%s-%x' % (fp, int(snapshot[0] * 1e6))
+        else:
+            trace_id = hashlib.sha1(repr(snapshot[0]) + '.' + '.'.join(snapshot[1:])).hexdigest()
+        self.timings.emit('trace_hash', start)
+        columns = None
+        if self.columns:
+            exc_type = exc_type or sys.exc_info()[0]
+            columns = dict(timestamp=snapshot[0],
+                           code=code,
+                           endpoint=request.endpoint,
+                           exception=exc_type.__name__ if exc_type else None,
+                           fingerprint=fp)
+        return trace_id, snapshot, columns
 
     def set(self, request, response):
+        """Add a request and its response into the request cache, returns the trace id."""
+        trace_id, snapshot, columns = self.capture(request, response.status_code)
+        snapshot.append(self.response_body(response))
+        if self.store(trace_id, snapshot, columns):
+            return trace_id
+
+    def set_error(self, request, error, exc_type=None):
+        """
+        Trace an error of exc_type before its response is serialized.
+
+        The error is stored as the response body with the trace id, which is only added to
+        the error and returned once the trace is stored or queued.
+        """
+        trace_id, snapshot, columns = self.capture(request, error.get('code'), exc_type)
+        traced = dict(error, id=trace_id)
+        snapshot.append(truncate(json.dumps(dict(error=traced), separators=(',', ':')),
+                                 self.limits['response_body']))
+        if self.store(trace_id, snapshot, columns):
+            error['id'] = trace_id
+            return trace_id
+
+    def store(self, trace_id, snapshot, columns=None):
+        """Store a snapshot, in the background with a writer, False when it was dropped."""
+        if self.writer is not None:
+            return self.writer.put(trace_id, snapshot, columns)
+        self.write(trace_id, snapshot, columns)
+        return True
+
+    def write(self, trace_id, snapshot, columns=None):
+        """Serialize and store a snapshot under the trace id."""
+        self.write_many([(trace_id, snapshot, columns)])
+
+    def write_many(self, items):
         """
-        Add a request into the request cache.
-
-        Requests are serialized into a string where each element is base64 encoded. The trace id
-        generated is a hash of the serialized request data which is returned from the method.
-        """
-        base64_stack_trace = b64encode(traceback.format_exc())
-        base64_timestamp = b64encode(str(time.time()))
-        request_json_body = json.dumps(request.get_json(), separators=(',', ':'))
-        request_base64_body = b64encode(str(request_json_body))
-        request_base64_headers = b64encode(str(request.headers))
-        response_json_body = json.dumps(response.data, separators=(',', ':'))
-        response_base64_body = b64encode(str(response_json_body))
-        data = '{}.{}.{}.{}.{}'.format(base64_timestamp,
-                                       base64_stack_trace,
-                                       request_base64_headers,
-                                       request_base64_body,
-                                       response_base64_body)
-        trace_id = hashlib.sha1(data).hexdigest()
-        self.cache.set(trace_id, data)
-        return trace_id
+        Serialize and store `(trace_id, snapshot)` pairs or `(trace_id, snapshot, columns)`.
+
+        Plain traces are stored with a single cache set_many, grouped occurrences update the
+        keys of their fingerprint once per batch.
+        """
+        traces = {}
+        groups = {}
+        for item in items:
+            trace_id, snapshot = item[:2]
+            columns = item[2] if len(item) > 2 else None
+            if '-' not in trace_id:
+                traces[trace_id] = (self.dumps(snapshot), columns)
+            else:
+                groups.setdefault(trace_id.split('-', 1)[0], []).append((snapshot, columns))
+        start = self.timings.clock()
+        if traces and self.columns:
+            self.cache.set_traces([(trace_id, data, columns or {})
+                                   for trace_id, (data, columns) in traces.items()])
+        elif traces:
+            self.cache.set_many(dict((trace_id, data)
+                                     for trace_id, (data, _) in traces.items()))
+        # Grouped, the first occurrence is kept as exemplar
+        for key, occurrences in groups.items():
+            snapshots = [snapshot for snapshot, _ in occurrences]
+            if self.columns:
+                self.cache.set_traces([(key, self.dumps(snapshots[0]), occurrences[0][1] or {})],
+                                      add=True)
+            else:
+                self.cache.add(key, self.dumps(snapshots[0]))
+            self.cache.add(key + ':count', 0)
+            count = self.cache.inc(key + ':count', len(snapshots))
+            if count is None or not self.occurrences:
+                continue
+            # Each occurrence owns the slot of its number in a ring of `occurrences` keys,
+            # numbered by the atomic inc so concurrent writers never overwrite each other
+            recent = snapshots[-self.occurrences:]
+            first = count - len(recent)
+            self.cache.set_many(dict((self.slot(key, first + i), snapshot[0])
+                                     for i, snapshot in enumerate(recent)))
+        self.timings.emit('cache', start)
+
+    def slot(self, key, number):
+        """Key of the timestamp of an occurrence of a fingerprint."""
+        return '%s:t%d' % (key, number % self.occurrences)
 
     def get(self, trace_id):
         """This method returns a Trace corresponding to the trace ID passed in."""
-        data = self.cache.get(trace_id)
-        if data is None:
-            return None
-        components = data.split('.')
-        base64_timestamp = components[0]
-        base64_stack_trace = components[1]
-        base64_request_headers = components[2]
-        base64_request_body = components[3]
-        base64_response_body = components[4]
-        timestamp = float(b64decode(base64_timestamp))
-        stack_trace = b64decode(base64_stack_trace)
-        request_headers = b64decode(base64_request_headers)
-        request_body = json.loads(b64decode(base64_request_body))
-        response_body = json.loads(b64decode(base64_response_body))
-        return Trace(timestamp, stack_trace, request_headers, request_body, response_body)
+        return self.get_many([trace_id])[0]
+
+    def get_many(self, trace_ids):
+        """
+        Traces of the trace ids, in order, with None for missing traces.
+
+        All keys are fetched with a single cache get_many.
+        """
+        keys = []
+        for trace_id in trace_ids:
+            if '-' in trace_id:
+                key = trace_id.split('-', 1)[0]
+                keys.extend((key, key + ':count'))
+                keys.extend(self.slot(key, i) for i in range(self.occurrences or 0))
+            else:
+                keys.append(trace_id)
+        keys = list(set(keys))
+        start = self.timings.clock()
+        values = dict(zip(keys, self.cache.get_many(*keys))) if keys else {}
+        self.timings.emit('cache', start)
+
+        traces = []
+        for trace_id in trace_ids:
+            if '-' not in trace_id:
+                data = values.get(trace_id)
+                traces.append(self.loads(data) if data is not None else None)
+                continue
+            # Exemplar trace of the fingerprint with the timestamp of the occurrence
+            key, occurred = trace_id.split('-', 1)
+            data = values.get(key)
+            if data is None:
+                traces.append(None)
+                continue
+            trace = self.loads(data)
+            trace.timestamp = int(occurred, 16) / 1e6
+            trace.fingerprint = key
+            trace.occurrences = values.get(key + ':count')
+            timestamps = [values.get(self.slot(key, i)) for i in range(self.occurrences or 0)]
+            trace.timestamps = sorted(timestamp for timestamp in timestamps
+                                      if timestamp is not None)
+            traces.append(trace)
+        if self.metrics is not None:
+            hits = len([trace for trace in traces if trace is not None])
+            self.metrics.inc('logex_trace_cache_total', 'hit', value=hits)
+            self.metrics.inc('logex_trace_cache_total', 'miss', value=len(traces) - hits)
+        return traces
+
+    def query(self, start=None, end=None, code=None, endpoint=None, exception=None,
+              fingerprint=None, limit=100, offset=0):
+        """
+        Trace ids and traces matching the filters, newest first.
+
+        Traces are filtered by time range, `start <= timestamp < end`, status code, endpoint,
+        exception type name and fingerprint, and paginated with limit and offset. Grouped
+        traces are returned once, as their exemplar. Requires a cache storing the trace
+        columns, like the `sqlite` cache type.
+        """
+        if not self.columns:
+            raise TypeError("%s does not support queries" % type(self.cache).__name__)
+        rows = self.cache.query(start=start, end=end, code=code, endpoint=endpoint,
+                                exception=exception, fingerprint=fingerprint,
+                                limit=limit, offset=offset)
+        trace_ids = [key if not fp else '%s-%x' % (key, int(timestamp * 1e6))
+                     for key, timestamp, fp in rows]
+        return zip(trace_ids, self.get_many(trace_ids))
@@ -0,0 +1,133 @@
+"""
+Background trace writer.
+
+Traces are captured on the request thread and handed to a worker thread that serializes and
+stores them in the cache in batches, keeping the cache round-trip off the request path.
+
+:copyright: (c) 2016 Pinn Technologies, Inc.
+:license: All rights reserved
+"""
+
+import atexit
+import os
+import threading
+import time
+import weakref
+import Queue
+
+_stop = object()
+# Writers of this process, closed once at exit
+_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(_writers):
+        writer.close()
+
+
+class TraceWriter(object):
+    """Bounded queue drained by a single worker thread writing traces through a Tracer."""
+
+    def __init__(self, tracer, maxsize=1000, policy='drop', timeout=1.0, batch_size=100):
+        """
+        Create a writer for the tracer.
+
+        Parameters
+        ----------
+        tracer : flask_logex.trace.Tracer
+            Tracer used to serialize and store the traces.
+        maxsize : int
+            Maximum number of traces waiting to be written.
+        policy : str
+            `drop` discards traces when the queue is full, `block` waits up to `timeout`
+            seconds for room before discarding.
+        timeout : float
+            Seconds to wait for room in the queue with the `block` policy.
+        batch_size : int
+            Maximum number of queued traces written with a single Tracer.write_many.
+        """
+        if policy not in ('drop', 'block'):
+            raise ValueError("%s is not a valid trace queue policy" % policy)
+        self.tracer = tracer
+        self.policy = policy
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(maxsize)
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="logex-trace-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        _writers.add(self)
+
+    def _count(self, name, count=1, reason=None):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + count)
+        if reason and self.tracer.metrics is not None:
+            self.tracer.metrics.inc('logex_dropped_total', 'trace', reason, value=count)
+
+    @property
+    def stats(self):
+        """Counters of enqueued, written and dropped traces."""
+        with self._lock:
+            return dict(enqueued=self.enqueued, written=self.written, dropped=self.dropped)
+
+    def put(self, trace_id, snapshot, columns=None):
+        """Queue a trace snapshot, returns False when it was dropped."""
+        try:
+            if self.policy == 'block':
+                self.queue.put((trace_id, snapshot, columns), True, self.timeout)
+            else:
+                self.queue.put_nowait((trace_id, snapshot, columns))
+        except Queue.Full:
+            self._count('dropped', reason='queue')
+            return False
+        self._count('enqueued')
+        return True
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            items = [item for item in batch if item is not _stop]
+            try:
+                if items:
+                    self.tracer.write_many(items)
+                    self._count('written', len(items))
+            except Exception:
+                self._count('dropped', len(items), reason='error')
+            finally:
+                for item in batch:
+                    queue.task_done()
+            if len(items) != len(batch):
+                return
+
+    def flush(self, timeout=None):
+        """Wait for queued traces to be written, returns False on timeout."""
+        if os.getpid() != self._pid or not self._thread.is_alive():
+            return False
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=5.0):
+        """Flush queued traces and stop the worker thread."""
+        _writers.discard(self)
+        if not self.flush(timeout):
+            return
+        self.queue.put(_stop)
+        self._thread.join(timeout)
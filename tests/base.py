@@ -32,6 +32,7 @@ class BaseTestCase(TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        cls.logex.flush()
         subprocess.call(['rm', '-rf', 'logs'])
 
     def setUp(self):
@@ -134,6 +134,7 @@ class BlueprintsTests(BaseTestCase):
             pass
 
     def file_size(self, log_name):
+        self.logex.flush()
         log_path = self.logex.LOG_PATH
         return os.stat("{}{}".format(log_path, log_name)).st_size
 
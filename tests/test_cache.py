@@ -1,9 +1,26 @@
 """Test Logex Initization and Error Handling"""
 
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 from base import BaseTestCase
+from flask import Flask
+from flask import request
+from flask_logex import LogEx
+from werkzeug.exceptions import NotFound
 from werkzeug.wrappers import Response
 from werkzeug.contrib.cache import NullCache
 from werkzeug.contrib.cache import RedisCache
+from werkzeug.contrib.cache import SimpleCache
+from flask_logex import caches
+from flask_logex.caches import LRUCache, TieredCache
+from flask_logex.segments import SegmentCache
+from flask_logex.sqlite import SQLiteCache
+from flask_logex.trace import Tracer, BinarySerializer, LegacySerializer, _missing
+from flask_logex.writer import TraceWriter, _writers
 
 
 class CacheTests(BaseTestCase):
@@ -20,6 +37,16 @@ class CacheTests(BaseTestCase):
         else:
             self.assertTrue(isinstance(cache, RedisCache))
 
+    def test_cache_shared(self):
+        tracer = self.logex.tracer
+        cache = tracer.cache
+        self.assertIs(self.logex.tracer, tracer)
+        self.assertIs(self.logex.cache, cache)
+        # A forked worker builds its own client
+        self.logex.state._cache_pid = -1
+        self.assertIsNot(self.logex.cache, cache)
+        self.assertIsNot(self.logex.tracer, tracer)
+
     def test_trace_id(self):
         # assert self.logex.tracer is not None
         from flask import request
@@ -38,3 +65,307 @@ class CacheTests(BaseTestCase):
             self.assertTrue(hasattr(trace, 'request_headers'))
             self.assertTrue(hasattr(trace, 'request_body'))
             self.assertTrue(hasattr(trace, 'response_body'))
+
+    def test_trace_limits(self):
+        tracer = Tracer(SimpleCache(), limits=dict(request_body=16, response_body=8))
+        body = '{"items": [%s]}' % ', '.join(['1'] * 10)
+        with self.app.test_request_context('/hello', method='POST', data=body,
+                                           content_type='application/json'):
+            trace = tracer.get(tracer.set(request, Response('x' * 20)))
+        self.assertEqual(trace.request_body, '[skipped %d bytes]' % len(body))
+        self.assertEqual(trace.response_body, 'x' * 8 + '...[truncated 12 bytes]')
+        with self.app.test_request_context('/hello', method='POST', data='{"a":1}',
+                                           content_type='application/json'):
+            # Streamed and binary responses are never read
+            streamed = Response(iter(['x'] * 20), direct_passthrough=True)
+            trace = tracer.get(tracer.set(request, streamed))
+            self.assertEqual(trace.request_body, {'a': 1})
+            self.assertEqual(trace.response_body, '[streamed response]')
+            binary = Response('\x00' * 20, mimetype='application/octet-stream')
+            trace = tracer.get(tracer.set(request, binary))
+            self.assertEqual(trace.response_body, '[skipped application/octet-stream body]')
+        self.assertTrue(streamed.is_streamed)
+
+    def test_trace_error_failed(self):
+        class FailingCache(SimpleCache):
+            def set_many(self, mapping, timeout=None):
+                raise IOError("cache down")
+        tracer = Tracer(FailingCache())
+        error = dict(code=500, message="failed")
+        self.assertRaises(IOError, tracer.set_error, request, error)
+        # No id pointing to a trace that was never stored
+        self.assertEqual(error, dict(code=500, message="failed"))
+        trace_id = Tracer(SimpleCache()).set_error(request, error)
+        self.assertEqual(error['id'], trace_id)
+
+    def test_trace_error_dropped(self):
+        app = Flask("dropped")
+        app.route("/fail")(lambda: {}["missing"])
+        logex = LogEx(app, cache_config={'LOGEX_CACHE_TYPE': 'simple'})
+        state = logex.get_state(app)
+        tracer = state.tracer
+        # Stopped writer with a full queue, the next trace is dropped
+        tracer.writer = TraceWriter(tracer, maxsize=1)
+        tracer.writer.close()
+        self.assertTrue(tracer.writer.put('queued', []))
+        response = app.test_client().get("/fail")
+        self.assertEqual(response.status_code, 500)
+        self.assertNotIn('id', json.loads(response.data)['error'])
+        self.assertEqual(state.metrics.value('logex_traces_total', 500), 0)
+        self.assertEqual(state.metrics.value('logex_dropped_total', 'trace', 'queue'), 1)
+        self.assertIsNone(tracer.set(request, Response('dropped')))
+
+    def test_trace_writer(self):
+        from flask import request
+        tracer = Tracer(SimpleCache())
+        tracer.writer = TraceWriter(tracer, maxsize=10)
+        trace_id = tracer.set(request, Response('hello world'))
+        self.assertTrue(tracer.writer.flush(1))
+        trace = tracer.get(trace_id)
+        self.assertIsNotNone(trace)
+        self.assertEqual(trace.response_body, 'hello world')
+        self.assertEqual(tracer.writer.stats, dict(enqueued=1, written=1, dropped=0))
+        self.assertIn(tracer.writer, _writers)
+        tracer.writer.close()
+        self.assertNotIn(tracer.writer, _writers)
+
+    def test_trace_writer_rebuild(self):
+        app = Flask("writers")
+        logex = LogEx(app, cache_config={'LOGEX_CACHE_TYPE': 'simple', 'LOGEX_TRACE_ASYNC': True})
+        state = logex.get_state(app)
+        writer = state.tracer.writer
+        # Rebuilding the cache stops the previous writer instead of keeping it for exit
+        logex.init_cache(app, None)
+        self.assertIsNot(state.tracer.writer, writer)
+        self.assertFalse(writer._thread.is_alive())
+        self.assertNotIn(writer, _writers)
+        state.reset_cache()
+
+    def test_trace_formats(self):
+        from flask import request
+        response = Response('{"error": {"code": 500}}')
+        cache = SimpleCache()
+        legacy = Tracer(cache, serializer=LegacySerializer())
+        legacy_id = legacy.set(request, response)
+        for serializer in (BinarySerializer(), BinarySerializer(compress=True)):
+            tracer = Tracer(cache, serializer=serializer)
+            trace_id = tracer.set(request, response)
+            self.assertTrue(cache.get(trace_id).startswith(BinarySerializer.MAGIC))
+            trace = tracer.get(trace_id)
+            self.assertEqual(trace.response_body, response.data)
+            # Both formats are readable by any tracer
+            legacy_trace = tracer.get(legacy_id)
+            self.assertEqual(legacy_trace.response_body, trace.response_body)
+            self.assertEqual(legacy_trace.stack_trace, trace.stack_trace)
+            self.assertEqual(legacy_trace.request_headers, trace.request_headers)
+            self.assertEqual(legacy_trace.request_body, trace.request_body)
+
+    def test_trace_fingerprint(self):
+        from flask import request
+        tracer = Tracer(SimpleCache(), fingerprint=True, occurrences=2)
+        response = Response('{"error": {"code": 500}}')
+        trace_ids = []
+        for i in range(3):
+            try:
+                {}['missing']
+            except KeyError:
+                trace_ids.append(tracer.set(request, response))
+        fingerprints = set(trace_id.split('-')[0] for trace_id in trace_ids)
+        self.assertEqual(len(fingerprints), 1)
+        trace = tracer.get(trace_ids[-1])
+        self.assertEqual(trace.fingerprint, fingerprints.pop())
+        self.assertEqual(trace.occurrences, 3)
+        self.assertEqual(len(trace.timestamps), 2)
+        self.assertIn('KeyError', trace.stack_trace)
+
+    def test_trace_occurrences(self):
+        tracer = Tracer(LRUCache(), fingerprint=True, occurrences=100)
+        snapshot = [0, 'stack', 'headers', 'body', 'response']
+
+        def write(worker):
+            for i in range(25):
+                tracer.write('fp-%x' % i, [worker * 100 + i] + snapshot[1:])
+        # Concurrent writers keep every occurrence, each one in its own slot
+        workers = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        trace = tracer.get('fp-0')
+        self.assertEqual(trace.occurrences, 100)
+        self.assertEqual(trace.timestamps,
+                         sorted(w * 100 + i for w in range(4) for i in range(25)))
+        tracer.write_many([('fp-1', [1000 + i] + snapshot[1:]) for i in range(150)])
+        trace = tracer.get('fp-0')
+        self.assertEqual(trace.occurrences, 250)
+        self.assertEqual(trace.timestamps, range(1050, 1150))
+
+    def test_trace_lazy(self):
+        from flask import request
+        for serializer in (LegacySerializer(), BinarySerializer()):
+            tracer = Tracer(SimpleCache(), serializer=serializer)
+            trace_id = tracer.set(request, Response('{"error": {"code": 500}}'))
+            trace = tracer.get(trace_id)
+            self.assertFalse(hasattr(trace, '__dict__'))
+            self.assertEqual(trace.response_body, '{"error": {"code": 500}}')
+            # Only the accessed field was decoded
+            self.assertEqual(trace._values.count(_missing), 4)
+
+    def test_trace_get_many(self):
+        from flask import request
+        tracer = Tracer(SimpleCache())
+        response = Response('{"error": {"code": 500}}')
+        trace_ids = [tracer.set(request, response) for i in range(3)]
+        traces = tracer.get_many([trace_ids[2], 'missing', trace_ids[0]])
+        self.assertEqual(len(traces), 3)
+        self.assertIsNone(traces[1])
+        self.assertEqual(traces[0].timestamp, tracer.get(trace_ids[2]).timestamp)
+        self.assertEqual(traces[2].timestamp, tracer.get(trace_ids[0]).timestamp)
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_bytes=30)
+        cache.set('a', 'x' * 10)
+        cache.set('b', 'x' * 10)
+        cache.set('c', 'x' * 10)
+        self.assertEqual(cache.size, 30)
+        # Reading marks as recently used, least recently used is evicted
+        self.assertIsNotNone(cache.get('a'))
+        cache.set('d', 'x' * 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get_many('a', 'c', 'd'), ['x' * 10] * 3)
+        self.assertFalse(cache.add('a', 'y'))
+        self.assertEqual(cache.inc('n'), 1)
+        self.assertEqual(cache.inc('n', 2), 3)
+        cache.set('e', 'x', timeout=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('e'))
+        self.assertTrue(cache.add('e', 'y'))
+        # Values larger than the cache are refused without evicting the others
+        self.assertFalse(cache.set('f', 'x' * 31))
+        self.assertIsNone(cache.get('f'))
+        self.assertEqual(cache.get('e'), 'y')
+
+    def test_tiered_cache(self):
+        remote = SimpleCache()
+        cache = TieredCache(LRUCache(), remote)
+        cache.set('a', 'trace')
+        self.assertEqual(remote.get('a'), 'trace')
+        self.assertEqual(cache.local.get('a'), 'trace')
+        # Read-through fills the local cache
+        remote.set('b', 'other')
+        self.assertEqual(cache.get_many('a', 'b', 'c'), ['trace', 'other', None])
+        self.assertEqual(cache.local.get('b'), 'other')
+        remote.delete('b')
+        self.assertEqual(cache.get('b'), 'other')
+        self.assertEqual(cache.inc('n'), 1)
+        self.assertEqual(cache.inc('n'), 2)
+        # Counts and occurrences written by other nodes are never read from the local copy
+        cache.inc('fp:count')
+        cache.set('fp:t0', 1.0)
+        remote.inc('fp:count')
+        remote.set('fp:t0', 2.0)
+        self.assertEqual(cache.get_many('fp:count', 'fp:t0'), [2, 2.0])
+        self.assertIsNone(cache.local.get('fp:t0'))
+        config = dict(LOGEX_CACHE_TIERED_BACKEND='tiered')
+        self.assertRaises(ValueError, caches.tiered, None, config, [], {})
+
+    def test_segment_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = SegmentCache(cache_dir, segment_bytes=64, max_age=60)
+            for i in range(10):
+                cache.set('trace-%d' % i, 'x' * 20)
+            self.assertGreater(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(cache.get_many('trace-0', 'trace-9', 'missing'),
+                             ['x' * 20, 'x' * 20, None])
+            self.assertFalse(cache.add('trace-0', 'y'))
+            self.assertEqual(cache.inc('n'), 1)
+            self.assertEqual(cache.inc('n', 2), 3)
+            self.assertTrue(cache.delete('trace-1'))
+            self.assertIsNone(cache.get('trace-1'))
+            # Another process sharing the directory rebuilds the index from the segments
+            other = SegmentCache(cache_dir)
+            self.assertEqual(other.get('trace-9'), 'x' * 20)
+            self.assertIsNone(other.get('trace-1'))
+            cache.set('late', 'z')
+            self.assertEqual(other.get('late'), 'z')
+            # Keys already indexed are read back with the value written last by any process
+            other.set('late', 'y')
+            self.assertEqual(cache.get('late'), 'y')
+            # Lookups only scan the segments again once another writer appended
+            scans = []
+            catch_up = cache._catch_up
+            cache._catch_up = lambda: scans.append(1) or catch_up()
+            self.assertEqual(cache.get_many('late', 'trace-9', 'missing'), ['y', 'x' * 20, None])
+            self.assertEqual(scans, [])
+            other.set('late', 'w')
+            self.assertEqual(cache.get('late'), 'w')
+            self.assertEqual(cache.get('late'), 'w')
+            self.assertEqual(scans, [1])
+            del cache._catch_up
+            pids = []
+            for i in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    for j in range(25):
+                        other.inc('shared')
+                    os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+            self.assertEqual(cache.get('shared'), 100)
+            # Old segments expire as a whole on rotation
+            first = os.path.join(cache_dir, sorted(os.listdir(cache_dir))[0])
+            os.utime(first, (0, 0))
+            cache.set('big', 'x' * 100)
+            cache.set('next', 'x')
+            self.assertFalse(os.path.exists(first))
+            self.assertIsNone(cache.get('trace-0'))
+            self.assertEqual(cache.get('next'), 'x')
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_sqlite_query(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = SQLiteCache(os.path.join(cache_dir, 'traces.sqlite'), default_timeout=0)
+            cache.set('a', 'trace')
+            self.assertEqual(cache.get_many('a', 'b'), ['trace', None])
+            self.assertFalse(cache.add('a', 'other'))
+            # Expired rows do not block adding their key
+            cache.set_traces([('old', 'expired', {})])
+            with cache._connection() as connection:
+                connection.execute("UPDATE traces SET expires = 1 WHERE key = 'old'")
+            cache.set_traces([('old', 'new', {'code': 500}), ('a', 'other', {})], add=True)
+            self.assertEqual(cache.get_many('old', 'a'), ['new', 'trace'])
+            self.assertEqual(cache.inc('n', 2), 2)
+            self.assertEqual(cache.inc('n'), 3)
+
+            tracer = Tracer(cache, fingerprint=True)
+            with self.app.test_request_context('/api/sample', method='POST'):
+                for code in (500, 500, 422):
+                    try:
+                        raise KeyError(code)
+                    except KeyError:
+                        tracer.set_error(request, dict(code=code))
+            tracer.fingerprint = False
+            with self.app.test_request_context('/api/sample', method='POST'):
+                # Recorded as the exception handled, not the last one raised
+                tracer.set_error(request, dict(code=404), NotFound)
+            # Grouped traces are returned once
+            self.assertEqual(len(tracer.query()), 2)
+            traces = tracer.query(code=500)
+            self.assertEqual(len(traces), 1)
+            trace_id, trace = traces[0]
+            self.assertEqual(trace.occurrences, 3)
+            self.assertEqual(tracer.query(exception='KeyError')[0][0], trace_id)
+            self.assertEqual(len(tracer.query(code=404, start=time.time() - 60)), 1)
+            self.assertEqual(len(tracer.query(exception='NotFound')), 1)
+            self.assertRaises(TypeError, Tracer(SimpleCache()).query)
+            self.assertEqual(tracer.query(end=0), [])
+            self.assertEqual(tracer.query(limit=1, offset=1)[0][0], trace_id)
+            # Traces survive a new connection
+            reopened = Tracer(SQLiteCache(os.path.join(cache_dir, 'traces.sqlite')))
+            self.assertEqual(reopened.get(trace_id).stack_trace, trace.stack_trace)
+        finally:
+            shutil.rmtree(cache_dir)
@@ -1,8 +1,12 @@
 """Test Logex Initization and Error Handling"""
 
+import gc
 import json
 import os
+import threading
+import time
 from base import BaseTestCase
+from flask_logex.metrics import Metrics
 
 
 class SamplesTests(BaseTestCase):
@@ -76,7 +80,76 @@ class SamplesTests(BaseTestCase):
         except ImportError:
             pass
 
+    def test_trace_id(self):
+        resp = self.test_client.get("/api/custom")
+        error = json.loads(resp.data)["error"]
+        self.assertEqual(len(error["id"]), 40)
+        # Not traced codes
+        resp = self.test_client.get("/api/bad")
+        self.assertNotIn("id", json.loads(resp.data)["error"])
+
+    def test_metrics(self):
+        metrics = self.logex.metrics
+        labels = (500, "custom_exception", "custom")
+        count = metrics.value('logex_errors_total', *labels)
+        self.resource_check("/app/custom", 500)
+        self.assertEqual(metrics.value('logex_errors_total', *labels), count + 1)
+        data = self.logex.metrics_view().data
+        self.assertIn('logex_errors_total{code="500",type="custom_exception",endpoint="custom"}',
+                      data)
+        self.assertIn('logex_log_seconds_count', data)
+
+    def test_metrics_threads(self):
+        metrics = Metrics()
+        threads = [threading.Thread(target=metrics.inc, args=('logex_traces_total', 500))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        del thread, threads
+        # Shards of finished threads are folded once their thread is released
+        deadline = time.time() + 5
+        while metrics._shards and time.time() < deadline:
+            gc.collect()
+            time.sleep(0.01)
+        self.assertEqual(metrics._shards, {})
+        self.assertEqual(metrics.value('logex_traces_total', 500), 8)
+        metrics.inc('logex_traces_total', 500)
+        self.assertEqual(len(metrics._shards), 1)
+        self.assertEqual(metrics.value('logex_traces_total', 500), 9)
+
+    def test_timings(self):
+        stages = []
+        listener = self.logex.timings.connect(lambda stage, seconds: stages.append(stage))
+        try:
+            self.resource_check("/api/custom", 500)
+        finally:
+            self.logex.timings.disconnect(listener)
+        for stage in ('handle_http_exception', 'handler', 'stack_trace', 'trace_hash',
+                      'cache', 'log_exception'):
+            self.assertIn(stage, stages)
+        self.assertEqual(self.logex.timings.clock(), None)
+
+    def test_user_agent_cache(self):
+        user_agents = self.logex.user_agents
+        hits = user_agents.hits
+        for i in range(2):
+            self.test_client.get("/app/custom", headers={'User-Agent': 'curl/7.47.0'})
+        self.assertEqual(user_agents.hits, hits + 1)
+        self.assertEqual(user_agents.parse('curl/7.47.0'), (None, None, None))
+        self.assertGreater(self.logex.metrics.value('logex_user_agent_cache_total', 'hit'), 0)
+        # Least recently used strings are evicted
+        maxsize = user_agents.maxsize
+        user_agents.maxsize = 1
+        try:
+            user_agents.parse('Mozilla/5.0 (X11; Linux x86_64) Firefox/45.0')
+            self.assertEqual(list(user_agents._parsed),
+                             ['Mozilla/5.0 (X11; Linux x86_64) Firefox/45.0'])
+        finally:
+            user_agents.maxsize = maxsize
+
     def file_size(self, log_name):
+        self.logex.flush()
         log_path = self.logex.LOG_PATH
         return os.stat("{}{}".format(log_path, log_name)).st_size
 
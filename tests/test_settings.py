@@ -1,12 +1,40 @@
 """Test Logex Initization and Error Handling"""
 
+import json
 import logging
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 from flask_logex.logger import log_exception, get_logger
+from flask import Flask
+from flask_logex import LogEx
+from flask_logex.defaults import Plugin, __plugins__
+from flask_logex.logger import JSONFormatter, LogListener, QueueHandler, _listeners
+from flask_logex.sink import LogSink
 from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response
 
 from base import BaseTestCase
-from samples import SampleException
+from samples import SampleException, CustomException, handle_custom_exception
+
+
+# Parent buffers a record and forks, the child exits through sys.exit
+FORK_EXIT = """
+import logging, os, sys
+from flask_logex.sink import LogSink
+sink = LogSink(sys.argv[1], flush_interval=0)
+logger = logging.Logger("sink")
+logger.addHandler(sink)
+logger.error("parent")
+pid = os.fork()
+if pid == 0:
+    sys.exit(0)
+os.waitpid(pid, 0)
+sink.close()
+"""
 
 
 class SettingsTests(BaseTestCase):
@@ -27,21 +55,273 @@ class SettingsTests(BaseTestCase):
             path = log_path + log_name + '.log'
             self.assertTrue(os.path.isfile(path))
             logger = self.logs[log_name]
-            _logger = get_logger(log_name)
-            self.assertEqual(logger, _logger)
+            self.assertEqual(logger.name, log_name)
+            # Loggers of the application, not those of logging.getLogger
+            self.assertIsNot(logger, get_logger(log_name))
+            self.assertIs(logger, self.logex.state.logger(log_name))
 
     def test_after_request(self):
         funcs = self.app.after_request_funcs
         self.assertEqual(funcs[None], [self.logex.process_response])
 
+    def test_process_response_fast_path(self):
+        # Non-error responses are returned without parsing the body
+        response = Response('not json')
+        self.assertIs(self.logex.process_response(response), response)
+        self.assertEqual(response.data, 'not json')
+
     def test_0_logging(self):
         for log_name in self.logex.logs.keys():
             log = self.logex.LOG_PATH + log_name + ".log"
             self.assertTrue(os.stat(log).st_size == 0)
-            log_exception(log_name, "message", "trace_id")
+            log_exception(self.logs[log_name], "message", "trace_id")
+            self.logex.flush()
             self.assertTrue(os.stat(log).st_size > 0)
             open(log, 'w').close()
 
+    def test_log_queue(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "queued.log")
+        listener = LogListener()
+        handler = logging.FileHandler(path)
+        listener.set_handler("queued", handler)
+        logger = get_logger("queued")
+        logger.addHandler(QueueHandler(listener))
+        try:
+            try:
+                raise SampleException("description")
+            except SampleException:
+                logger.exception("message")
+            self.assertTrue(listener.flush(1))
+            with open(path) as f:
+                data = f.read()
+            self.assertIn("message", data)
+            self.assertIn("SampleException", data)
+            self.assertIn(listener, _listeners)
+            listener.stop()
+            self.assertNotIn(listener, _listeners)
+        finally:
+            del logger.handlers[:]
+            handler.close()
+            shutil.rmtree(directory)
+
+    def test_log_sink(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "sink.log")
+        logger = logging.Logger("sink")
+        try:
+            # Two sinks stand for workers rotating the same file
+            sinks = [LogSink(directory, max_bytes=1024, backups=2, flush_interval=0)
+                     for i in range(2)]
+            for sink in sinks:
+                sink.add("sink")
+                logger.addHandler(sink)
+            logger.error("buffered")
+            self.assertEqual(os.stat(path).st_size, 0)
+            sinks[0].flush()
+            sinks[1].flush()
+            with open(path) as f:
+                self.assertEqual(f.read(), "buffered\nbuffered\n")
+            for i in range(100):
+                logger.error("%03d %s", i, "x" * 60)
+                sinks[i % 2].flush()
+            self.assertTrue(all(sink.rotations for sink in sinks))
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ["sink.log", "sink.log.1", "sink.log.2"])
+            for name in os.listdir(directory):
+                self.assertLessEqual(os.stat(os.path.join(directory, name)).st_size, 1024)
+            # Forked workers drop the parent's buffer and write their own records
+            logger.error("parent")
+            pid = os.fork()
+            if pid == 0:
+                logger.error("child")
+                sinks[0].flush()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            with open(path) as f:
+                data = f.read()
+            self.assertIn("child", data)
+            self.assertNotIn("parent", data)
+            sinks[0].close()
+            with open(path) as f:
+                self.assertIn("parent", f.read())
+            # A child exiting normally flushes at exit without writing the parent's records
+            os.remove(path)
+            subprocess.check_call([sys.executable, "-c", FORK_EXIT, directory],
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            with open(path) as f:
+                self.assertEqual(f.read(), "parent\n")
+        finally:
+            for sink in sinks:
+                sink.close()
+            shutil.rmtree(directory)
+
+    def test_log_json(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "structured.log")
+        handler = logging.FileHandler(path)
+        handler.setFormatter(JSONFormatter())
+        logger = get_logger("structured")
+        logger.addHandler(handler)
+        with self.app.test_request_context('/api/sample', method='POST',
+                                           headers={'User-Agent': 'curl/7.47.0'}):
+            try:
+                raise SampleException("description")
+            except SampleException:
+                log_exception("structured", "message", "trace_id", 422, structured=True)
+        handler.close()
+        del logger.handlers[:]
+        with open(path) as f:
+            lines = f.read().splitlines()
+        shutil.rmtree(directory)
+        self.assertEqual(len(lines), 1)
+        event = json.loads(lines[0])
+        self.assertEqual(event['trace_id'], "trace_id")
+        self.assertEqual(event['method'], "POST")
+        self.assertEqual(event['code'], 422)
+        self.assertEqual(event['exception'], "SampleException")
+        self.assertEqual(event['user_agent'], "curl/7.47.0")
+        self.assertEqual(event['level'], "ERROR")
+        self.assertIn("SampleException", event['stack'])
+
+    def test_dispatch(self):
+        class SubCustomException(CustomException):
+            pass
+        # Subclasses resolve to the handler and logger of their base
+        handler, logger_name = self.logex.dispatch(SubCustomException)
+        self.assertEqual(handler, handle_custom_exception)
+        self.assertEqual(logger_name, "custom_exception")
+        self.assertIn(SubCustomException, self.logex.config.dispatch)
+        handler, logger_name = self.logex.dispatch(SampleException)
+        self.assertIsNone(handler)
+        self.assertEqual(logger_name, self.app.logger_name)
+
+    def test_config(self):
+        app = Flask("config")
+        logex = LogEx(app)
+        config = logex.get_state(app).config
+        self.assertIn(500, config.trace_codes)
+        self.assertRaises(AttributeError, setattr, config, 'log_json', True)
+        self.assertRaises(TypeError, config.handlers.update, {KeyError: None})
+        # Settings are copied per instance, not shared with the defaults
+        other = LogEx(handlers={KeyError: None})
+        self.assertIn(KeyError, other.handlers)
+        self.assertNotIn(KeyError, self.logex.handlers)
+        logex.register_handler(KeyError)
+        frozen = logex.get_state(app).config
+        self.assertIsNot(frozen, config)
+        self.assertIn(KeyError, frozen.handlers)
+        self.assertNotIn(KeyError, config.handlers)
+
+    def test_register_handler_serving(self):
+        app = Flask("serving")
+        app.debug = True
+        app.add_url_rule("/ok", "ok", lambda: "ok")
+        app.route("/fail")(lambda: {}["missing"])
+        logex = LogEx(app, cache_config={'LOGEX_CACHE_TYPE': 'simple'})
+        client = app.test_client()
+        self.assertEqual(client.get("/ok").status_code, 200)
+        # Debug applications refuse app.errorhandler after their first request
+        logex.register_handler(KeyError, lambda e: dict(code=409, message="key", type="key"))
+        self.assertIn(KeyError, logex.get_state(app).config.handlers)
+        response = client.get("/fail")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)["error"]["type"], "key")
+
+    def test_plugins(self):
+        class PluginException(Exception):
+            pass
+        loaded = []
+
+        def load():
+            loaded.append(True)
+            return {PluginException: "plugin"}, {PluginException: handle_custom_exception}
+        # Plugin of this module's exceptions, loaded when first handled
+        __plugins__["test"] = Plugin("test", __name__.split('.')[0], load)
+        try:
+            self.assertEqual(loaded, [])
+            handler, logger_name = self.logex.dispatch(PluginException)
+            self.assertEqual(loaded, [True])
+            self.assertEqual(handler, handle_custom_exception)
+            self.assertEqual(logger_name, "plugin")
+            self.assertIn("plugin", self.logex.logs)
+            self.assertTrue(self.logex.enable_plugin("test"))
+            self.assertEqual(loaded, [True])
+            self.assertRaises(ValueError, LogEx(plugins=["missing"]).init_plugins)
+            # Eager plugins are activated by init_app even when their package is not imported
+            __plugins__["eager"] = Plugin("eager", "not_imported", load, eager=True)
+            loaded[:] = []
+            other = LogEx()
+            threads = [threading.Thread(target=other.enable_plugin, args=("eager",))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            other.init_plugins()
+            for thread in threads:
+                thread.join()
+            self.assertIn("eager", other._enabled)
+            self.assertEqual(loaded, [True])
+            # Plugins enabled after init_app reach applications already serving requests
+            class LateException(Exception):
+                pass
+
+            def late_fail():
+                raise LateException("late")
+            app = Flask("late")
+            app.debug = True
+            app.add_url_rule("/ok", "ok", lambda: "ok")
+            app.add_url_rule("/fail", "fail", late_fail)
+            late = LogEx(app, cache_config={'LOGEX_CACHE_TYPE': 'simple'})
+            client = app.test_client()
+            self.assertEqual(client.get("/ok").status_code, 200)
+            __plugins__["late"] = Plugin("late", "not_imported", lambda: (
+                {LateException: "late"},
+                {LateException: lambda e: dict(code=409, message="late", type="late")}))
+            self.assertTrue(late.enable_plugin("late"))
+            response = client.get("/fail")
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(json.loads(response.data)["error"]["type"], "late")
+        finally:
+            del __plugins__["test"]
+            __plugins__.pop("eager", None)
+            __plugins__.pop("late", None)
+            self.logex._enabled.discard("test")
+            self.logex.handlers.pop(PluginException, None)
+            self.logex.loggers.pop(PluginException, None)
+            self.logex.logs.pop("plugin", None)
+            self.logex.reset_dispatch()
+
+    def test_multiple_apps(self):
+        logex = LogEx(cache_config={'LOGEX_CACHE_TYPE': 'simple'})
+        apps = [Flask("first"), Flask("second")]
+        for app in apps:
+            app.route("/fail")(lambda: {}["missing"])
+            logex.init_app(app)
+        first, second = [logex.get_state(app) for app in apps]
+        self.assertIsNot(first, second)
+        self.assertIs(apps[0].extensions['logex'], first)
+        self.assertIsNot(first.cache, second.cache)
+        self.assertIsNot(first.metrics, second.metrics)
+        self.assertIn("second", second.logs)
+        self.assertNotIn("second", first.logs)
+        # Requests resolve the state of their own application
+        response = apps[0].test_client().get("/fail")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(first.metrics.value('logex_traces_total', 500), 1)
+        self.assertEqual(second.metrics.value('logex_traces_total', 500), 0)
+        with apps[1].app_context():
+            self.assertIs(logex.state, second)
+            self.assertIs(logex.cache, second.cache)
+        # Registrations after init_app reach every application
+        logex.register_handler(KeyError)
+        self.assertIn(KeyError, first.config.handlers)
+        self.assertIn(KeyError, second.config.handlers)
+        # Each application logs a shared logger name with its own logger
+        logex.register_logger(KeyError, "shared")
+        self.assertIsNot(first.logs["shared"], second.logs["shared"])
+        self.assertEqual(first.logs["shared"].name, second.logs["shared"].name)
+        self.assertEqual(get_logger("shared").handlers, [])
+
     def test_sample_error(self):
         test_error = SampleException("description")
         self.assertIsInstance(test_error, HTTPException)
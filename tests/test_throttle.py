@@ -0,0 +1,48 @@
+"""Test Logex Sampling and Rate Limiting"""
+
+from base import BaseTestCase
+from flask_logex.throttle import Throttle
+from samples import CustomException, SampleException
+
+
+class ThrottleTests(BaseTestCase):
+
+    def test_unthrottled(self):
+        throttle = Throttle()
+        for i in range(10):
+            self.assertEqual(throttle.check(500, CustomException), (True, 0))
+
+    def test_sample_rates(self):
+        # Exception classes match subclasses before falling back on codes
+        throttle = Throttle(sample_rates={Exception: 0, 422: 1})
+        self.assertFalse(throttle.check(422, SampleException)[0])
+        throttle = Throttle(sample_rates={CustomException: 0, 422: 1})
+        self.assertTrue(throttle.check(422, SampleException)[0])
+        self.assertFalse(throttle.check(500, CustomException)[0])
+
+    def test_rate_limits(self):
+        throttle = Throttle(rate_limits={500: (0, 2)}, summary_interval=3600)
+        self.assertEqual(throttle.check(500, CustomException), (True, 0))
+        self.assertEqual(throttle.check(500, CustomException), (True, 0))
+        self.assertEqual(throttle.check(500, CustomException), (False, 0))
+        self.assertEqual(throttle.check(500, CustomException), (False, 0))
+        self.assertEqual(throttle.suppressed[(500, CustomException)], 2)
+
+    def test_summary(self):
+        throttle = Throttle(rate_limits={500: (0, 1)}, summary_interval=0)
+        self.assertEqual(throttle.check(500, CustomException), (True, 0))
+        self.assertEqual(throttle.check(500, CustomException), (False, 1))
+        self.assertEqual(throttle.check(500, CustomException), (False, 1))
+
+    def test_pending(self):
+        throttle = Throttle(rate_limits={500: (0, 1)}, summary_interval=3600)
+        self.assertEqual(throttle.check(500, CustomException), (True, 0))
+        self.assertEqual(throttle.check(500, CustomException), (False, 0))
+        self.assertEqual(throttle.check(500, CustomException), (False, 0))
+        # Counts of events that stopped are reported without a later event of their own
+        self.assertEqual(throttle.pending(), [])
+        self.assertEqual(throttle.pending(force=True), [(500, CustomException, 2)])
+        self.assertEqual(throttle.pending(force=True), [])
+        self.assertEqual(throttle.check(500, CustomException), (False, 0))
+        throttle.summary_interval = 0
+        self.assertEqual(throttle.pending(), [(500, CustomException, 1)])